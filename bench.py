@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+
+"""Measures the overhead tracerlib adds to representative workloads.
+
+Each workload is timed untraced and under each tracing configuration, and
+the overhead is reported in nanoseconds per trace event, the events being
+those ``sys.settrace`` would deliver for the workload. Results can be saved
+as JSON and compared with a previous run::
+
+    python bench.py --save before.json
+    python bench.py --compare before.json
+"""
+
+from __future__ import print_function, division
+
+import argparse
+import collections
+import json
+import platform
+import sys
+import time
+
+import tracerlib
+
+_clock = getattr(time, 'perf_counter', time.time)
+
+
+def fib(n):
+    if n < 2:
+        return n
+    return fib(n - 1) + fib(n - 2)
+
+def recursion():
+    fib(16)
+
+def loop():
+    total = 0
+    for i in range(5000):
+        total += i
+        if total % 7 == 0:
+            total -= 1
+    return total
+
+def small(i):
+    return i + 1
+
+def calls():
+    for i in range(2000):
+        small(i)
+
+class Point(object):
+
+    def __init__(self, x, y):
+        self.x = x
+        self.y = y
+
+    def scaled(self, factor):
+        return Point(self.x * factor, self.y * factor)
+
+def methods():
+    p = Point(1, 2)
+    for i in range(1000):
+        p = p.scaled(1)
+
+def numbers(n):
+    for i in range(n):
+        yield i
+
+def generators():
+    return sum(numbers(2000))
+
+def raiser(i):
+    raise ValueError(i)
+
+def exceptions():
+    for i in range(500):
+        try:
+            raiser(i)
+        except ValueError:
+            pass
+
+
+WORKLOADS = collections.OrderedDict([
+    ('recursion', recursion),
+    ('loop', loop),
+    ('calls', calls),
+    ('methods', methods),
+    ('generators', generators),
+    ('exceptions', exceptions),
+])
+
+
+NESTED_CONFIG = """
+match:bench.*
+    -match:bench.raiser
+        true:True
+    match:bench.fib
+        sample:10
+"""
+
+class CountingTracer(tracerlib.Tracer):
+
+    def __init__(self, **kwargs):
+        super(CountingTracer, self).__init__(**kwargs)
+        self.count = 0
+
+    def trace_call(self, func_name, inspector, args, kwargs):
+        self.count += 1
+
+
+CONFIGS = collections.OrderedDict([
+    ('manager', lambda: tracerlib.TracerManager()),
+    ('match-none', lambda: tracerlib.TracerManager(tracerlib.Tracer(watch=['other.*']))),
+    ('match', lambda: tracerlib.TracerManager(tracerlib.Tracer(watch=['bench.*']))),
+    ('match-call', lambda: tracerlib.TracerManager(
+        CountingTracer(events=['call'], watch=['bench.*']))),
+    ('line', lambda: tracerlib.TracerManager(tracerlib.Tracer(
+        events=['line'], watch=['bench.*', 'line:%d' % (loop.__code__.co_firstlineno + 3)]))),
+    ('true', lambda: tracerlib.TracerManager(tracerlib.Tracer(watch=['true:True']))),
+    ('stack', lambda: tracerlib.TracerManager(tracerlib.StackTracer(tracerlib.NullSink()))),
+    ('callgraph', lambda: tracerlib.TracerManager(tracerlib.CallGraphTracer())),
+    ('config', lambda: tracerlib.ConfigLoader().loads(NESTED_CONFIG)),
+])
+
+
+def count_events(workload):
+    """The number of events sys.settrace delivers for the workload's frames."""
+
+    counts = collections.Counter()
+    def trace(frame, event, arg):
+        if frame.f_globals is globals():
+            counts[event] += 1
+            return trace
+        return None
+    sys.settrace(trace)
+    try:
+        workload()
+    finally:
+        sys.settrace(None)
+    return sum(counts.values())
+
+def best_time(workload, repeat, manager=None):
+    """The fastest of ``repeat`` runs of the workload, in seconds."""
+
+    best = None
+    for i in range(repeat):
+        if manager is not None:
+            manager.start()
+        try:
+            start = _clock()
+            workload()
+            end = _clock()
+        finally:
+            if manager is not None:
+                manager.stop()
+        if best is None or end - start < best:
+            best = end - start
+    return best
+
+def run(workloads, configs, repeat):
+    results = {
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'repeat': repeat,
+        'events': collections.OrderedDict(),
+        'untraced': collections.OrderedDict(),
+        'backends': collections.OrderedDict(),
+        'overhead': collections.OrderedDict(),
+    }
+    for name in workloads:
+        workload = WORKLOADS[name]
+        results['events'][name] = count_events(workload)
+        results['untraced'][name] = best_time(workload, repeat)
+    for config in configs:
+        manager = CONFIGS[config]()
+        with manager:
+            results['backends'][config] = tracerlib._backend.name
+        overhead = results['overhead'][config] = collections.OrderedDict()
+        for name in workloads:
+            seconds = best_time(WORKLOADS[name], repeat, manager)
+            extra = seconds - results['untraced'][name]
+            overhead[name] = extra * 1e9 / results['events'][name]
+    return results
+
+def report(results, previous=None, out=None):
+    workloads = list(results['events'])
+    print('Python %s (%s) on %s' % (results['python'], results['implementation'],
+                                    results['platform']), file=out)
+    print('', file=out)
+    print('%-12s %10s %12s' % ('workload', 'events', 'untraced ms'), file=out)
+    for name in workloads:
+        print('%-12s %10d %12.3f' % (name, results['events'][name],
+                                     results['untraced'][name] * 1e3), file=out)
+    print('', file=out)
+    print('Overhead in ns per event%s' % (
+        ', and the ratio to the previous run' if previous else ''), file=out)
+    print('%-12s %-10s' % ('config', 'backend') +
+          ''.join(' %16s' % name for name in workloads), file=out)
+    for config, overhead in results['overhead'].items():
+        cells = []
+        for name in workloads:
+            cell = '%.0f' % overhead[name]
+            old = (previous or {}).get('overhead', {}).get(config, {}).get(name)
+            if old:
+                cell += ' x%.2f' % (overhead[name] / old)
+            cells.append(' %16s' % cell)
+        print('%-12s %-10s' % (config, results['backends'][config]) + ''.join(cells),
+              file=out)
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('names', nargs='*', metavar='NAME',
+                        help="workloads and configurations to run, all by default: %s"
+                        % ', '.join(list(WORKLOADS) + list(CONFIGS)))
+    parser.add_argument('--repeat', type=int, default=5,
+                        help="runs of each workload, of which the fastest is kept")
+    parser.add_argument('--save', metavar='FILE', help="save the results as JSON")
+    parser.add_argument('--compare', metavar='FILE', help="compare with saved results")
+    options = parser.parse_args(args)
+
+    for name in options.names:
+        if name not in WORKLOADS and name not in CONFIGS:
+            parser.error("Unknown workload or configuration %r" % (name,))
+    workloads = [name for name in options.names if name in WORKLOADS] or list(WORKLOADS)
+    configs = [name for name in options.names if name in CONFIGS] or list(CONFIGS)
+
+    previous = None
+    if options.compare:
+        with open(options.compare) as f:
+            previous = json.load(f)
+    results = run(workloads, configs, options.repeat)
+    report(results, previous)
+    if options.save:
+        with open(options.save, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
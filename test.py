@@ -1,15 +1,37 @@
 from __future__ import print_function
 
+import io
+import os
 import sys
+import shutil
+import tempfile
+import multiprocessing
+import signal
 import unittest
+import threading
 import collections
+import gc
+import time
+import weakref
 
 import mock
 
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
 import tracerlib
 
 import testmod
 
+try:
+    import testasync
+    import asyncio
+except SyntaxError:
+    # Python 2
+    testasync = None
+
 
 def foobar(x, *args, **kwargs):
     return sys._getframe()
@@ -40,6 +62,22 @@ class FrameInspectorTestCase(unittest.TestCase):
         self.assertEqual(args['*args'], (2,))
         self.assertEqual(args['**kwargs'], {'a': 'b'})
 
+    def test_slots(self):
+        self.assertFalse(hasattr(self.inspector, '__dict__'))
+
+    def test_args_computed_once(self):
+        self.assertIs(self.inspector.all_arg_values(), self.inspector.all_arg_values())
+        self.assertIs(self.inspector.args, self.inspector.args)
+
+    @unittest.skipIf(sys.version_info[0] < 3, "requires keyword-only arguments")
+    def test_keyword_only(self):
+        ns = {'sys': sys}
+        exec("def kwonly(a, *args, b=2, **kwargs):\n    return sys._getframe()\n", ns)
+        inspector = tracerlib.FrameInspector(ns['kwonly'](1, 3, c=4))
+        self.assertEqual(['a', 'b', '*args', '**kwargs'], list(inspector.all_arg_values()))
+        self.assertEqual((1, 2, 3), inspector.args)
+        self.assertEqual({'c': 4}, inspector.kwargs)
+
     def test_global_func_qual_name(self):
         q = tracerlib.FrameInspector(testmod.f()).qual_name
         self.assertEqual('testmod.f', q)
@@ -48,6 +86,29 @@ class FrameInspectorTestCase(unittest.TestCase):
         q = tracerlib.FrameInspector(testmod.A().m1()).qual_name
         self.assertEqual('testmod.A.m1', q)
 
+class CodeInfoTestCase(unittest.TestCase):
+
+    def test_cached_per_code(self):
+        code = testmod.f.__code__
+        self.assertIs(tracerlib.code_info(code), tracerlib.code_info(code))
+
+    def test_shared_by_inspectors(self):
+        a = tracerlib.FrameInspector(testmod.A().m1())
+        b = tracerlib.FrameInspector(testmod.A().m1())
+        self.assertIs(a.code_info, b.code_info)
+        self.assertEqual('testmod.A.m1', a.code_info.qual_name)
+        self.assertFalse(a.code_info.is_global)
+
+    def test_released_with_code(self):
+        ns = {}
+        exec("def dynamic():\n    pass\n", ns)
+        key = id(ns['dynamic'].__code__)
+        tracerlib.code_info(ns['dynamic'].__code__)
+        self.assertIn(key, tracerlib._code_infos)
+        del ns['dynamic']
+        self.assertNotIn(key, tracerlib._code_infos)
+
+
 Record = collections.namedtuple('Record', ['event', 'func_name'])
 
 class TracerManagerTestCase(unittest.TestCase):
@@ -113,6 +174,222 @@ class TracerManagerTestCase(unittest.TestCase):
         self.assertEqual('g', self.get_record('call', 1).func_name)
         self.assertEqual('f', self.get_record('call', 2).func_name)
 
+    def test_local_trace_pruned(self):
+        tm = tracerlib.TracerManager(tracerlib.Tracer(watch=['testmod.f']))
+        self.assertTrue(tm._trace(testmod.f(), 'call', None))
+        self.assertFalse(tm._trace(testmod.A().m1(), 'call', None))
+
+    def test_local_trace_call_only(self):
+        tm = tracerlib.TracerManager(tracerlib.Tracer(events=['call']))
+        self.assertFalse(tm._trace(testmod.f(), 'call', None))
+
+    def test_local_trace_plain_function(self):
+        self.assertTrue(self.tm._trace(testmod.A().m1(), 'call', None))
+
+    def test_dispatch_by_event(self):
+        calls = tracerlib.Tracer(events=['call'])
+        lines = tracerlib.Tracer(events=['line'])
+        calls.dispatch = mock.Mock(return_value=True)
+        lines.dispatch = mock.Mock(return_value=True)
+        tm = tracerlib.TracerManager(calls, lines, self.record)
+        tm._trace(testmod.f(), 'line', None)
+        calls.dispatch.assert_not_called()
+        self.assertEqual(1, lines.dispatch.call_count)
+        self.assertEqual(['line'], [record.event for record in self.records])
+        self.assertTrue(tm._dispatch_index().plain)
+        index = tracerlib.TracerManager(calls, lines)._dispatch_index()
+        self.assertEqual((set(['call', 'line']), False), (index.needs, index.plain))
+
+    def test_dispatch_index_rebuilt(self):
+        tracer = tracerlib.Tracer(events=['call'])
+        tracer.dispatch = mock.Mock(return_value=True)
+        tm = tracerlib.TracerManager(tracer)
+        tm._trace(testmod.f(), 'line', None)
+        tracer.events = ['call', 'line']
+        tm._trace(testmod.f(), 'line', None)
+        self.assertEqual(1, tracer.dispatch.call_count)
+        tm.remove(tracer)
+        tm._trace(testmod.f(), 'line', None)
+        self.assertEqual(1, tracer.dispatch.call_count)
+
+    def test_tracers_released_with_manager(self):
+        refs = []
+        for i in range(5):
+            tracer = tracerlib.StackTracer(tracerlib.NullSink())
+            with tracerlib.TracerManager(tracer):
+                testmod.a()
+            refs.append(weakref.ref(tracer))
+        del tracer
+        gc.collect()
+        self.assertEqual([None] * 5, [ref() for ref in refs])
+
+    def test_stats(self):
+        tracer = tracerlib.Tracer(events=['call'], watch=['testmod.a'])
+        tm = tracerlib.TracerManager(tracer, self.record, stats=True)
+        with tm:
+            testmod.a()
+        stats = tm.stats()
+        self.assertEqual(len(self.records), sum(stats['events'].values()))
+        tracer_stats, record_stats = stats['tracers']
+        self.assertIs(tracer, tracer_stats.tracer)
+        self.assertEqual(1, tracer_stats.dispatched)
+        # Its match rule leaves out the other functions before dispatching
+        self.assertEqual(0, tracer_stats.rejected)
+        self.assertEqual(len(self.records), record_stats.dispatched)
+        self.assertTrue(tracer_stats.time_ns > 0)
+        tm.reset_stats()
+        self.assertEqual({}, tm.stats()['events'])
+
+    def test_stats_errors(self):
+        def fail(frame, event, arg):
+            raise ValueError()
+        tm = tracerlib.TracerManager(fail, stats=True)
+        with mock.patch('sys.stderr'):
+            tm._trace(testmod.f(), 'call', None)
+        self.assertEqual(1, tm.stats()['tracers'][0].errors)
+
+    def test_budget_steps(self):
+        tracer = tracerlib.Tracer(events=['call', 'line'])
+        plain = lambda frame, event, arg: None
+        tm = tracerlib.TracerManager(tracer, plain, budget=0.05)
+        with mock.patch.object(tracerlib._log, 'warning') as warning:
+            tm._budget_step(tracer, 0.5)
+            self.assertEqual(['sample:10'], tracer._watch)
+            tm._budget_step(tracer, 0.5)
+            self.assertEqual(['call'], tracer.events)
+            tm._budget_step(tracer, 0.5)
+            tm._budget_step(plain, 0.5)
+            self.assertEqual(set([tracer, plain]), tm._suspended)
+            self.assertEqual(4, warning.call_count)
+            tm._budget_undo(0.01)
+            self.assertEqual(set([tracer]), tm._suspended)
+            self.assertEqual(5, warning.call_count)
+        tm.start()
+        tm.stop()
+        self.assertEqual(set(), tm._suspended)
+        self.assertEqual(['call', 'line'], tracer.events)
+        self.assertEqual([], tracer._watch)
+
+    def test_budget_exceeded(self):
+        class SlowTracer(tracerlib.Tracer):
+            def trace_call(self, func_name, inspector, args, kwargs):
+                testmod.spin(0.001)
+        tracer = SlowTracer(events=['call'], watch=['testmod.a'])
+        tm = tracerlib.TracerManager(tracer, budget=0.05, budget_interval=0.01)
+        with mock.patch.object(tracerlib._log, 'warning') as warning:
+            with tm:
+                for i in range(1000):
+                    testmod.a()
+                    if tracer in tm._suspended:
+                        break
+                self.assertIn(tracer, tm._suspended)
+        # Sampled, then suspended, as it only had call events already
+        steps = [c[0][3] for c in warning.call_args_list[:2]]
+        self.assertEqual(['sampling 1 in 10 calls of', 'suspending'], steps)
+        self.assertEqual(set(), tm._suspended)
+
+    def test_budget_steps_keep_stack(self):
+        tm = None
+        stepped = []
+        class StepTracer(tracerlib.StackTracer):
+            def trace_call(self, func_name, inspector, args, kwargs):
+                super(StepTracer, self).trace_call(func_name, inspector, args, kwargs)
+                if func_name == 'b' and not stepped:
+                    stepped.append(True)
+                    tm._budget_step(self, 0.5)
+                    tm._budget_step(self, 0.5)
+                    self.assertEqual(['call', 'exception', 'return'], self.events)
+                    tm._budget_undo(0.01)
+                    tm._budget_undo(0.01)
+        tracer = StepTracer(ListSink())
+        tracer.assertEqual = self.assertEqual
+        tracer.watch('testmod.*')
+        tm = tracerlib.TracerManager(tracer, budget=0.05, budget_interval=60)
+        with mock.patch.object(tracerlib._log, 'warning'):
+            with tm:
+                testmod.a()
+                testmod.a()
+        self.assertEqual(['testmod.a()', ' testmod.b()', ' return None', 'return None'],
+                         tracer.sink.lines[-4:])
+        self.assertEqual((0, 0), (tracer.depth, tracer.incall))
+
+    def test_budget_restored(self):
+        class SlowTracer(tracerlib.Tracer):
+            def trace_call(self, func_name, inspector, args, kwargs):
+                testmod.spin(0.002)
+        tracer = SlowTracer(events=['call'], watch=['testmod.a'])
+        tm = tracerlib.TracerManager(tracer, budget=0.05, budget_interval=0.01)
+        with mock.patch.object(tracerlib._log, 'warning'):
+            with tm:
+                # The process is busy outside of the tracer too
+                for i in range(1000):
+                    testmod.a()
+                    testmod.spin(0.002)
+                    if tracer in tm._suspended:
+                        break
+                self.assertIn(tracer, tm._suspended)
+                # No events arrive while it is suspended, yet it comes back
+                # once the process is idle
+                deadline = time.time() + 5
+                while tracer in tm._suspended and time.time() < deadline:
+                    time.sleep(0.01)
+                self.assertNotIn(tracer, tm._suspended)
+
+    def test_budget_steady_load(self):
+        tracer = tracerlib.Tracer(events=['call'])
+        tm = tracerlib.TracerManager(tracer, budget=0.05)
+        tm._budget_start = tm._budget_spent = tm._budget_cpu = 0
+        clock = {'now': 0, 'spent': 0, 'cpu': 0}
+        tm.stats = lambda: {'tracers': [tracerlib.TracerStats(tracer, 0, 0, 0, clock['spent'])]}
+        def run(interval, cost, busy=True):
+            clock['now'] += interval + cost
+            clock['spent'] += cost
+            if busy:
+                clock['cpu'] += interval + cost
+            with mock.patch.object(tracerlib, '_process_clock_ns', return_value=clock['cpu']):
+                tm._check_budget(clock['now'])
+            return tracer in tm._suspended
+
+        with mock.patch.object(tracerlib._log, 'warning') as warning:
+            # The process is always busy, and the tracer takes half as long
+            # again while it isn't suspended
+            suspended = []
+            for i in range(30):
+                cost = 0 if tracer in tm._suspended else 50000000
+                suspended.append(run(100000000, cost))
+            self.assertEqual([False] + [True] * 29, suspended)
+            self.assertEqual(['sampling 1 in 10 calls of', 'suspending'],
+                             [c[0][3] for c in warning.call_args_list])
+
+            # Once the process is idle, it is restored
+            self.assertFalse(run(100000000, 0, False))
+            run(100000000, 0, False)
+        self.assertEqual([], tm._budget_steps)
+
+    def test_budget_current_cost(self):
+        first = tracerlib.Tracer(events=['call'])
+        second = tracerlib.Tracer(events=['call'])
+        tm = tracerlib.TracerManager(first, second, budget=0.05)
+        tm._budget_start = tm._budget_spent = tm._budget_cpu = 0
+        times = {first: 0, second: 0}
+        tm.stats = lambda: {'tracers': [tracerlib.TracerStats(t, 0, 0, 0, times[t])
+                                        for t in (first, second)]}
+        now = 0
+        with mock.patch.object(tracerlib._log, 'warning'):
+            # The first tracer is expensive, then idle while the second is
+            for tracer, cost in ((first, 400000000), (second, 200000000)):
+                times[tracer] += cost
+                now += 1000000000
+                with mock.patch.object(tracerlib, '_process_clock_ns', return_value=now):
+                    tm._check_budget(now)
+        self.assertEqual([first, second], [step[0] for step in tm._budget_steps])
+
+    def test_stats_off(self):
+        with self.tm:
+            testmod.a()
+        self.assertEqual({}, self.tm.stats()['events'])
+        self.assertRaises(TypeError, tracerlib.TracerManager, stat=True)
+
 
 class TracerTestCase(unittest.TestCase):
 
@@ -184,6 +461,33 @@ class TracerTestCase(unittest.TestCase):
         self.assertEqual(1, self.mock.call_count)
         self.mock.assert_called_with('v', args=(), kwargs={}, lineno=12)
 
+    def test_watch_callable(self):
+        self.tracer.events = ['line']
+        self.tracer.watch('testmod.v')
+        condition = lambda frame, event, arg: frame.f_locals.get('a') == 2
+        self.tracer.watch(condition)
+
+        with self.tm:
+            testmod.v()
+
+        self.assertEqual(1, self.mock.call_count)
+        self.mock.assert_called_with('v', args=(), kwargs={}, lineno=12)
+
+        self.tracer.unwatch(condition)
+        self.assertEqual(['testmod.v'], self.tracer._watch)
+
+    def test_condition_errors(self):
+        self.tracer.events = ['line']
+        self.tracer.watch('testmod.v')
+        self.tracer.watch('true:undefined_name')
+
+        with self.tm:
+            testmod.v()
+
+        self.assertEqual(0, self.mock.call_count)
+        self.assertEqual(3, self.tracer.condition_errors)
+        self.assertIsInstance(self.tracer._rules[-1].last_error, NameError)
+
     def test_incall(self):
         self.tracer.watch('testmod.a')
 
@@ -194,6 +498,73 @@ class TracerTestCase(unittest.TestCase):
             with mock.patch('testmod.b', test):
                 testmod.a()
 
+    def test_inspector_shared_per_frame(self):
+        seen = []
+        class LineTracer(tracerlib.Tracer):
+            def trace_line(self, func_name, lineno):
+                seen.append(self.frame_insp)
+        tm = tracerlib.TracerManager(LineTracer(watch=['testmod.v']),
+                                     LineTracer(watch=['testmod.v']))
+        with mock.patch.object(tracerlib.FrameInspector, 'all_arg_values') as args:
+            with tm:
+                testmod.v()
+        self.assertEqual(6, len(seen))
+        self.assertEqual(1, len(set(map(id, seen))))
+        self.assertEqual(0, args.call_count)
+
+    def test_sample_every_nth(self):
+        tracer = tracerlib.Tracer(self.mock, ['call'], ['testmod.b'], sample=3)
+        with tracerlib.TracerManager(tracer):
+            for i in range(7):
+                testmod.b()
+        self.assertEqual(3, self.mock.call_count)
+
+    def test_sample_fraction(self):
+        tracer = tracerlib.Tracer(self.mock, watch=['testmod.b', 'sample:0.5'])
+        with mock.patch('random.random', return_value=0.7):
+            with tracerlib.TracerManager(tracer):
+                testmod.b()
+        self.assertEqual(0, self.mock.call_count)
+        self.assertRaises(ValueError, tracer.watch, 'sample:1.5')
+        self.assertRaises(ValueError, tracer.watch, 'sample:0')
+
+    def test_sample_keeps_stack(self):
+        sink = ListSink()
+        tracer = tracerlib.StackTracer(sink)
+        tracer.watch('testmod.*')
+        tracer.watch('sample:2')
+        with tracerlib.TracerManager(tracer):
+            for i in range(3):
+                testmod.a()
+        self.assertEqual(['testmod.a()', ' testmod.b()', ' return None', 'return None'] * 2,
+                         sink.lines)
+        self.assertEqual(0, tracer.incall)
+
+        # A generator's resumes keep the decision of its call
+        for i in range(len(tracerlib._backends)):
+            sink = ListSink()
+            tracer = tracerlib.StackTracer(sink)
+            tracer.watch('testmod.g')
+            tracer.watch('sample:2')
+            with mock.patch.object(tracerlib, '_backends', tracerlib._backends[i:]):
+                with tracerlib.TracerManager(tracer):
+                    for j in range(3):
+                        list(testmod.g())
+            self.assertEqual(['testmod.g()', 'return None'] * 2, sink.lines)
+            self.assertEqual({}, tracer._thread_state.current().suspended)
+            self.assertEqual(0, tracer.incall)
+
+    def test_sample_c_events(self):
+        for i in range(len(tracerlib._backends)):
+            tracer = CallCTracer(events=['call', 'c_call'], watch=['testmod.c'], sample=2)
+            with mock.patch.object(tracerlib, '_backends', tracerlib._backends[i:]):
+                with tracerlib.TracerManager(tracer):
+                    for j in range(4):
+                        testmod.c()
+            self.assertEqual((['c'] * 2, [('c', len)] * 2), (tracer.calls, tracer.c_calls),
+                             tracerlib._backends[i].name)
+            self.assertEqual({}, getattr(tracerlib._backend, '_frames', {}))
+
     def test_child_tracer(self):
         t = mock.Mock()
         self.tracer.watch('testmod.a')
@@ -211,6 +582,853 @@ class TracerTestCase(unittest.TestCase):
             self.assertEqual(1, t.call_count)
 
 
+class WatchRuleTestCase(unittest.TestCase):
+
+    def test_compile_match(self):
+        rule = tracerlib.compile_rule('testmod.f')
+        self.assertIsInstance(rule, tracerlib.MatchRule)
+        self.assertEqual('testmod.f', rule.value)
+        self.assertFalse(rule.negate)
+
+    def test_compile_prefix(self):
+        rule = tracerlib.compile_rule('match:testmod.A.*')
+        self.assertIsInstance(rule, tracerlib.PrefixRule)
+        self.assertEqual('testmod.A', rule.value)
+
+    def test_compile_negated_line(self):
+        rule = tracerlib.compile_rule('-line:5')
+        self.assertIsInstance(rule, tracerlib.LineRule)
+        self.assertEqual(5, rule.value)
+        self.assertTrue(rule.negate)
+
+    def test_compile_condition(self):
+        rule = tracerlib.compile_rule('true:a==2')
+        self.assertIsInstance(rule, tracerlib.ConditionRule)
+        self.assertEqual('a==2', rule.value)
+
+    def test_condition_compiled_once(self):
+        a = tracerlib.compile_rule('true:a == 2')
+        b = tracerlib.compile_rule('-true:a == 2')
+        self.assertIs(a._code, b._code)
+
+    def test_compile_callable(self):
+        condition = lambda frame, event, arg: True
+        rule = tracerlib.compile_rule(condition)
+        self.assertIsInstance(rule, tracerlib.ConditionRule)
+        self.assertFalse(rule.negate)
+
+    def test_unwatch_removes_rule(self):
+        tracer = tracerlib.Tracer(watch=['testmod.f', 'line:5'])
+        tracer.unwatch('testmod.f')
+        self.assertEqual(['line:5'], tracer._watch)
+        self.assertEqual(1, len(tracer._rules))
+        self.assertIsInstance(tracer._rules[0], tracerlib.LineRule)
+
+    def test_code_decision_cached(self):
+        tracer = tracerlib.Tracer(watch=['testmod.f'])
+        fi = tracerlib.FrameInspector(testmod.f())
+        self.assertTrue(tracer.check_code(fi))
+        self.assertIn(fi.code_info.serial, tracer._code_decisions)
+
+        tracer.watch('-testmod.*')
+        self.assertFalse(tracer.check_code(fi))
+        tracer.unwatch('-testmod.*')
+        self.assertTrue(tracer.check_code(fi))
+
+    def test_one_decision_per_tracer(self):
+        tracer = tracerlib.Tracer(watch=['testmod.a'])
+        tm = tracerlib.TracerManager(tracer)
+        serial = tracerlib.code_info(testmod.a.__code__).serial
+        for i in range(20):
+            with tm:
+                testmod.a()
+                self.assertIn(serial, tracer._code_decisions)
+
+    def test_decisions_released_with_tracer(self):
+        tracer = tracerlib.Tracer(watch=['testmod.a'])
+        tracer.check_code(tracerlib.FrameInspector(testmod.f()))
+        ref = weakref.ref(tracer)
+        del tracer
+        gc.collect()
+        self.assertIsNone(ref())
+
+    def test_decisions_released_with_code(self):
+        tracer = tracerlib.Tracer(watch=['-testmod.*'])
+        ns = {}
+        exec("import sys\ndef dynamic():\n    return sys._getframe()\n", ns)
+        serial = tracerlib.FrameInspector(ns['dynamic']()).code_info.serial
+        tracer.check_code(tracerlib.FrameInspector(ns['dynamic']()))
+        self.assertIn(serial, tracer._code_decisions)
+        del ns['dynamic']
+        gc.collect()
+        self.assertNotIn(serial, tracer._code_decisions)
+
+    def test_dynamic_rules_not_cached(self):
+        tracer = tracerlib.Tracer(watch=['testmod.f', 'line:5', 'true:1'])
+        self.assertEqual(1, len(tracer._static_rules))
+        self.assertEqual(2, len(tracer._dynamic_rules))
+
+    def test_events_filter_without_rules(self):
+        tracer = tracerlib.Tracer(events=['line'])
+        frame = testmod.f()
+        self.assertFalse(tracer.check_event(frame, 'call', None))
+        self.assertTrue(tracer.check_event(frame, 'line', None))
+
+
+class WatchIndexTestCase(unittest.TestCase):
+
+    def test_same_as_rules(self):
+        watches = [
+            ['a.b'], ['a.b.*'], ['a.*', '-a.b.c'], ['a.bc.*', 'a.b.*'], ['-a.*'], [],
+            ['a.b*'], ['a.b.*', '-match:a.b.*'], ['a.b', 'a.b.c'], ['a.b.*', 'a.b.c.*'],
+            ['a.*', 'line:5'],
+        ]
+        tracers = [tracerlib.Tracer(watch=watch) for watch in watches]
+        index = tracerlib._WatchIndex(tracers + [self.assertTrue])
+        for name in ['a', 'a.b', 'a.bc', 'a.b.c', 'a.bc.d', 'a.b.cd', 'ab.c', 'a.b*', 'b']:
+            expected = set(tracer for tracer in tracers if all(
+                rule.matches(mock.Mock(qual_name=name), None, None) is not rule.negate
+                for rule in tracer._static_rules))
+            expected.add(self.assertTrue)
+            self.assertEqual(expected, index.tracers(name), name)
+
+    def test_dispatch_narrowed(self):
+        tracers = [tracerlib.Tracer(events=['call'], watch=['other%d.*' % i])
+                   for i in range(200)]
+        tracer = tracerlib.Tracer(events=['call'], watch=['testmod.f'])
+        tm = tracerlib.TracerManager(*(tracers + [tracer]))
+        with mock.patch.object(tracerlib.Tracer, 'dispatch') as dispatch:
+            tm._trace(testmod.f(), 'call', None)
+            tm._trace(testmod.A().m1(), 'call', None)
+        self.assertEqual([mock.call(mock.ANY, 'call', None)], dispatch.call_args_list)
+
+
+@unittest.skipIf(not hasattr(sys, 'monitoring'), "requires sys.monitoring")
+class MonitoringBackendTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.mock = mock.Mock()
+        self.tracer = tracerlib.Tracer(self.mock)
+        self.tm = tracerlib.TracerManager(self.tracer)
+
+    def test_selected_for_tracers(self):
+        with self.tm:
+            self.assertEqual('monitoring', tracerlib._backend.name)
+            self.assertIsNone(sys.gettrace())
+        self.assertIsNone(tracerlib._backend)
+
+    def test_settrace_for_plain_functions(self):
+        self.tm.add(lambda frame, event, arg: None)
+        with self.tm:
+            self.assertEqual('settrace', tracerlib._backend.name)
+
+    def test_events(self):
+        self.tracer.watch('testmod.v')
+        with self.tm:
+            testmod.v()
+        linenos = [c[1]['lineno'] for c in self.mock.call_args_list]
+        self.assertEqual([9, 10, 11, 12, 12], linenos)
+
+    def test_frames_forgotten_without_returns(self):
+        for events in (['line'], ['call', 'exception']):
+            tracer = tracerlib.Tracer(self.mock, events=events, watch=['testmod.v'])
+            with tracerlib.TracerManager(tracer):
+                for i in range(100):
+                    testmod.v()
+                self.assertEqual({}, tracerlib._backend._frames)
+
+    def test_exception(self):
+        self.tracer.events = ['exception']
+        self.tracer.watch('testmod.r')
+        with self.tm:
+            self.assertRaises(ValueError, testmod.r)
+        self.assertEqual(1, self.mock.call_count)
+
+    def test_c_return(self):
+        tracer = tracerlib.Tracer(self.mock, events=['c_return'], watch=['testmod.c'])
+        with tracerlib.TracerManager(tracer):
+            self.assertEqual('monitoring', tracerlib._backend.name)
+            testmod.c()
+        self.assertEqual(1, self.mock.call_count)
+
+    def test_rules_changed(self):
+        self.tracer.watch('testmod.f')
+        with self.tm:
+            testmod.a()
+            self.tracer.unwatch('testmod.f')
+            self.tracer.watch('testmod.a')
+            testmod.a()
+        self.assertNotEqual(0, self.mock.call_count)
+
+    def test_restarted_when_widened(self):
+        other = tracerlib.Tracer(self.mock, watch=['testmod.a'])
+        self.tracer.watch('testmod.f')
+        with mock.patch.object(sys.monitoring, 'restart_events',
+                               wraps=sys.monitoring.restart_events) as restart:
+            with self.tm:
+                testmod.a()
+                restart.reset_mock()
+                self.tracer.watch('-match:testmod.b')
+                self.tracer.watch('sample:2')
+                self.tracer.unwatch('sample:2')
+                restart.assert_not_called()
+                with tracerlib.TracerManager(other):
+                    self.assertEqual(1, restart.call_count)
+                    self.mock.reset_mock()
+                    testmod.a()
+                    self.assertNotEqual(0, self.mock.call_count)
+                self.tracer.unwatch('-match:testmod.b')
+                self.assertEqual(2, restart.call_count)
+
+
+class CTracer(tracerlib.Tracer):
+
+    def __init__(self, *args, **kwargs):
+        super(CTracer, self).__init__(*args, **kwargs)
+        self.c_calls = []
+
+    def trace_c_call(self, func_name, c_func):
+        self.c_calls.append((func_name, c_func))
+
+
+class CallCTracer(CTracer):
+
+    def __init__(self, *args, **kwargs):
+        super(CallCTracer, self).__init__(*args, **kwargs)
+        self.calls = []
+
+    def trace_call(self, func_name, inspector, args, kwargs):
+        self.calls.append(func_name)
+
+
+class ProfileBackendTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tracer = CTracer(events=['call', 'return', 'c_call'], watch=['testmod.c'])
+        self.tm = tracerlib.TracerManager(self.tracer)
+
+    def test_selected_without_lines(self):
+        with mock.patch.object(tracerlib, '_backends', tracerlib._backends[1:]):
+            with self.tm:
+                self.assertEqual('profile', tracerlib._backend.name)
+                self.assertIsNone(sys.gettrace())
+
+    def test_settrace_with_lines(self):
+        self.tracer.events = ['line', 'c_call']
+        with mock.patch.object(tracerlib, '_backends', tracerlib._backends[1:]):
+            with self.tm:
+                self.assertEqual('settrace', tracerlib._backend.name)
+                testmod.c()
+        self.assertEqual([('c', len)], self.tracer.c_calls)
+
+    def test_c_call(self):
+        with mock.patch.object(tracerlib, '_backends', tracerlib._backends[1:]):
+            with self.tm:
+                testmod.c()
+        self.assertEqual([('c', len)], self.tracer.c_calls)
+
+    def test_c_call_default_backend(self):
+        with self.tm:
+            testmod.c()
+        self.assertEqual([('c', len)], self.tracer.c_calls)
+
+    def test_no_c_events_for_plain_functions(self):
+        events = []
+        plain = lambda frame, event, arg: events.append(event)
+        self.tm.add(plain)
+        with self.tm:
+            testmod.c()
+        self.assertIn('call', events)
+        self.assertEqual([], [event for event in events if event.startswith('c_')])
+
+
+def in_thread(func, *args):
+    thread = threading.Thread(target=func, args=args)
+    thread.start()
+    return thread
+
+
+def wait_for(event):
+    event.wait(5)
+
+
+class ThreadTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.calls = []
+        self.tracer = tracerlib.Tracer(self.record, events=['call'], watch=['testmod.a'])
+        self.tm = tracerlib.TracerManager(self.tracer)
+
+    def record(self, func_name, **kwargs):
+        self.calls.append(threading.current_thread().name)
+
+    def check_backends(self, backends):
+        for i in range(len(backends)):
+            del self.calls[:]
+            with mock.patch.object(tracerlib, '_backends', backends[i:]):
+                with self.tm:
+                    in_thread(testmod.a).join()
+            self.assertEqual(1, len(self.calls), backends[i].name)
+            self.assertNotEqual(threading.current_thread().name, self.calls[0])
+
+    def test_new_threads_traced(self):
+        self.check_backends(tracerlib._backends)
+
+    @unittest.skipIf(not hasattr(threading, 'settrace_all_threads'),
+                     "requires threading.settrace_all_threads")
+    def test_running_threads_traced(self):
+        started = threading.Event()
+        release = threading.Event()
+        def run():
+            started.set()
+            wait_for(release)
+            testmod.a()
+        thread = in_thread(run)
+        started.wait(5)
+        with self.tm:
+            release.set()
+            thread.join()
+        self.assertEqual(1, len(self.calls))
+
+    def test_per_thread_stacks(self):
+        tracer = tracerlib.StackTracer(ListSink())
+        tracer.watch('test.wait_for')
+        release = threading.Event()
+        with tracerlib.TracerManager(tracer):
+            thread = in_thread(wait_for, release)
+            tracer.sink.waiting.wait(5)
+            self.assertEqual(0, tracer.depth)
+            self.assertEqual(0, tracer.incall)
+            done = threading.Event()
+            done.set()
+            wait_for(done)
+            release.set()
+            thread.join()
+        self.assertEqual(4, len(tracer.sink.lines))
+        self.assertEqual([], [line for line in tracer.sink.lines if line.startswith(' ')])
+
+    def test_internal_threads_not_traced(self):
+        tracer = tracerlib.Tracer(self.record, events=['call'])
+        sink = tracerlib.BufferedSink(ListSink())
+        with tracerlib.TracerManager(tracer):
+            for i in range(10):
+                sink.write(str(i))
+            sink.flush()
+        sink.close()
+        self.assertEqual(10, sink.written)
+        self.assertNotIn('tracerlib-sink', self.calls)
+
+
+class SwitchTracer(tracerlib.Tracer):
+
+    def __init__(self, *args, **kwargs):
+        super(SwitchTracer, self).__init__(*args, **kwargs)
+        self.switches = []
+
+    def trace_call(self, func_name, inspector, args, kwargs):
+        self.switches.append('call')
+
+    def trace_return(self, func_name, return_value):
+        self.switches.append('return')
+
+    def trace_resume(self, func_name, inspector):
+        self.switches.append('resume')
+
+    def trace_suspend(self, func_name, value):
+        self.switches.append('suspend %r' % (value,))
+
+
+class CoroutineTestCase(unittest.TestCase):
+
+    def test_generator_switches(self):
+        for i in range(len(tracerlib._backends)):
+            tracer = SwitchTracer(events=['call', 'return'], watch=['testmod.g'])
+            with mock.patch.object(tracerlib, '_backends', tracerlib._backends[i:]):
+                with tracerlib.TracerManager(tracer):
+                    list(testmod.g())
+            self.assertEqual(['call', 'suspend 1', 'resume', 'suspend 2', 'resume', 'return'],
+                             tracer.switches, tracerlib._backends[i].name)
+
+    @unittest.skipIf(testasync is None, "requires yield from")
+    def test_yield_from_switches(self):
+        for i in range(len(tracerlib._backends)):
+            tracer = SwitchTracer(events=['call', 'return'], watch=['testasync.delegate'])
+            with mock.patch.object(tracerlib, '_backends', tracerlib._backends[i:]):
+                with tracerlib.TracerManager(tracer):
+                    list(testasync.delegate())
+            self.assertEqual(['call', 'suspend 0', 'resume', 'suspend 1', 'resume', 'return'],
+                             tracer.switches, tracerlib._backends[i].name)
+
+    def test_generator_closed(self):
+        tracer = SwitchTracer(watch=['testmod.g'])
+        with tracerlib.TracerManager(tracer):
+            gen = testmod.g()
+            next(gen)
+            gen.close()
+        # From Python 3.13, closing a generator may not run its frame
+        self.assertIn(tracer.switches, (['call', 'suspend 1', 'resume', 'return'],
+                                        ['call', 'suspend 1']))
+
+    def test_default_resume_and_suspend(self):
+        tracer = tracerlib.Tracer()
+        tracer.trace_call = mock.Mock()
+        tracer._overrides_trace_call = True
+        tracer.trace_return = mock.Mock()
+        fi = tracerlib.FrameInspector(testmod.f())
+        tracer.trace_resume('f', fi)
+        tracer.trace_suspend('f', 1)
+        tracer.trace_call.assert_called_once_with('f', fi, (), {})
+        tracer.trace_return.assert_called_once_with('f', 1)
+
+    @unittest.skipIf(testasync is None, "requires asyncio")
+    def test_task_stacks(self):
+        tracer = tracerlib.StackTracer(ListSink())
+        tracer.watch('testasync.*')
+        with tracerlib.TracerManager(tracer):
+            asyncio.run(testasync.workers())
+        tasks = collections.defaultdict(list)
+        for line in tracer.sink.lines:
+            task, line = line.split('] ', 1)
+            tasks[task].append(line)
+        self.assertEqual(3, len(tasks))
+        self.assertIn(['testasync.workers()', 'return [1, 2]'], list(tasks.values()))
+        for n in (1, 2):
+            self.assertIn(['testasync.worker(%d)' % n, ' testasync.step(%d)' % n,
+                           ' return %d' % n, 'return %d' % n],
+                          list(tasks.values()))
+        self.assertEqual(0, tracer.incall)
+
+    @unittest.skipIf(testasync is None, "requires asyncio")
+    def test_suspended_time(self):
+        finished = []
+        class FrameTracer(tracerlib.StackFrameTracer):
+            def trace_return(self, func_name, return_value):
+                super(FrameTracer, self).trace_return(func_name, return_value)
+                finished.append(self)
+        tracer = tracerlib.StackTracer(ListSink())
+        tracer.frame_tracer = FrameTracer
+        tracer.watch('testasync.sleeper')
+        with tracerlib.TracerManager(tracer):
+            asyncio.run(testasync.sleeper(0.1))
+        self.assertEqual(1, len(finished))
+        self.assertGreaterEqual(finished[0].suspensions, 1)
+        self.assertGreaterEqual(finished[0].wall_ns, 0.1e9)
+        self.assertLess(finished[0].cpu_ns, 0.05e9)
+
+
+class ListSink(tracerlib.Sink):
+
+    def __init__(self):
+        self.lines = []
+        self.release = threading.Event()
+        self.release.set()
+        self.waiting = threading.Event()
+
+    def write(self, line):
+        self.waiting.set()
+        self.release.wait()
+        self.lines.append(line)
+
+
+class SinkTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.target = ListSink()
+
+    def fill(self, policy):
+        sink = tracerlib.BufferedSink(self.target, maxsize=2, policy=policy)
+        self.target.release.clear()
+        sink.write('first')
+        self.target.waiting.wait(5)
+        for line in ('a', 'b', 'c', 'd'):
+            sink.write(line)
+        self.target.release.set()
+        sink.close()
+        return sink
+
+    def test_buffered_writes_in_order(self):
+        sink = tracerlib.BufferedSink(self.target)
+        for i in range(100):
+            sink.write(str(i))
+        sink.flush()
+        self.assertEqual([str(i) for i in range(100)], self.target.lines)
+        self.assertEqual(100, sink.written)
+        sink.close()
+
+    def test_drop_newest(self):
+        sink = self.fill(tracerlib.BufferedSink.DROP_NEWEST)
+        self.assertEqual(['first', 'a', 'b'], self.target.lines)
+        self.assertEqual(2, sink.dropped)
+
+    def test_drop_oldest(self):
+        sink = self.fill(tracerlib.BufferedSink.DROP_OLDEST)
+        self.assertEqual(['first', 'c', 'd'], self.target.lines)
+        self.assertEqual(2, sink.dropped)
+
+    def test_stack_tracer_sink(self):
+        tracer = tracerlib.StackTracer(self.target)
+        tracer.watch('testmod.*')
+        with tracerlib.TracerManager(tracer):
+            testmod.a()
+        self.assertEqual(['testmod.a()', ' testmod.b()', ' return None', 'return None'],
+                         self.target.lines)
+
+
+class TimingTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tracer = tracerlib.StackTracer(ListSink())
+        self.tracer.watch('testmod.*')
+        self.tm = tracerlib.TracerManager(self.tracer)
+
+    def test_inclusive_and_exclusive(self):
+        with self.tm:
+            testmod.a()
+        timings = self.tracer.timings
+        a, b = timings['testmod.a'], timings['testmod.b']
+        self.assertEqual((1, 1), (a.count, b.count))
+        self.assertEqual(a.total_ns, a.self_ns + b.total_ns)
+        self.assertEqual(b.total_ns, b.self_ns)
+        self.assertEqual((a.total_ns, a.total_ns), (a.min_ns, a.max_ns))
+
+    def test_merged_across_threads(self):
+        with self.tm:
+            testmod.a()
+            in_thread(testmod.a).join()
+        self.assertEqual(2, self.tracer.timings['testmod.a'].count)
+
+    def test_report_at_stop(self):
+        self.tracer.report_timings = True
+        with self.tm:
+            testmod.a()
+        lines = self.tracer.sink.lines
+        self.assertEqual(['count', 'total', 'self', 'min', 'max'], lines[-3].split()[:5])
+        self.assertEqual(['1', 'testmod.a'], lines[-2].split()[::5])
+        self.assertEqual(['1', 'testmod.b'], lines[-1].split()[::5])
+
+    def test_frame_records(self):
+        records = []
+        class Record(tracerlib.FrameRecord):
+            __slots__ = ()
+            def trace_return(self, func_name, return_value):
+                super(Record, self).trace_return(func_name, return_value)
+                records.append(self)
+        self.tracer.frame_tracer = Record
+        with self.tm:
+            self.assertRaises(ValueError, testmod.r)
+        self.assertEqual('testmod.r', records[0].qual_name)
+        self.assertIs(ValueError, records[0].exc_type)
+        self.assertIs(type(None), records[0].return_type)
+        self.assertFalse(hasattr(records[0], '__dict__'))
+        self.assertFalse(hasattr(records[0], 'inspector'))
+
+    def test_retain_frames(self):
+        tracer = tracerlib.StackTracer(ListSink(), retain_frames=True)
+        tracer.watch('testmod.A.*')
+        records = []
+        tracer.trace_line = lambda *args: records.append(tracer.current)
+        with tracerlib.TracerManager(tracer):
+            testmod.A().m2(1, y=2)
+        self.assertIsInstance(records[0], tracerlib.StackFrameTracer)
+        self.assertEqual((1, 2), records[0].args[1:])
+        self.assertEqual('m2', records[0].inspector.func_name)
+
+    def test_finish(self):
+        tracer = tracerlib.Tracer()
+        tracer.finish = mock.Mock()
+        with tracerlib.TracerManager(tracer):
+            tracer.finish.assert_not_called()
+        tracer.finish.assert_called_once_with()
+
+
+class BoundedReprTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.repr = tracerlib.BoundedRepr(maxlength=40, maxitems=3, maxstring=10)
+
+    def test_limits(self):
+        self.assertEqual('[0, 1, 2, ...]', self.repr.repr(list(range(100000))))
+        self.assertEqual('[[[[...]]]]', self.repr.repr([[[[[1]]]]]))
+        self.assertEqual(10, len(self.repr.repr('x' * 1000)))
+        self.assertEqual(40, len(self.repr.repr([{'a': 'x' * 8}] * 3)))
+
+    def test_bytes(self):
+        data = b'x' * 10 ** 7
+        array = bytearray(data)
+        start = time.time()
+        self.assertEqual("b'x...xxx'", self.repr.repr(data))
+        self.assertEqual("byt...xx')", self.repr.repr(array))
+        # The whole repr of the data takes tens of milliseconds
+        self.assertLess(time.time() - start, 0.005)
+
+    def test_container_subclasses(self):
+        class Items(list):
+            def __repr__(self):
+                raise AssertionError("Not bounded")
+        self.assertEqual('Items([0, 1, 2, ...])', self.repr.repr(Items(range(100000))))
+        self.assertEqual("defaultdict({'a': [1]})",
+                         self.repr.repr(collections.defaultdict(list, a=[1])))
+        items = collections.OrderedDict((i, i) for i in range(1000))
+        self.assertEqual('OrderedDict({0: 0, 1: 1, 2: 2, ...})', self.repr.repr(items))
+        self.assertEqual("Record('call', 'f')", self.repr.repr(Record('call', 'f')))
+
+    def test_first_line(self):
+        class Lines(object):
+            def __repr__(self):
+                return 'first\nsecond'
+        self.assertEqual('first ...', self.repr.repr(Lines()))
+
+    def test_failing_repr(self):
+        class Broken(object):
+            def __repr__(self):
+                raise ValueError()
+        r = self.repr.repr(Broken())
+        self.assertTrue(r.startswith('<') and 'Broken' in r, r)
+
+    def test_types(self):
+        self.repr.types[dict] = lambda d: '<%d items>' % len(d)
+        self.assertEqual('<2 items>', self.repr.repr(collections.OrderedDict(a=1, b=2)))
+        self.assertEqual('[<0 items>]', self.repr.repr([{}]))
+
+    def test_cache(self):
+        self.assertEqual('1', self.repr.repr(1))
+        self.assertEqual('1.0', self.repr.repr(1.0))
+        self.assertEqual('True', self.repr.repr(True))
+        self.assertEqual('1', self.repr._cache[(int, 1)])
+        self.repr.repr('x' * 1000)
+        self.repr.repr([1])
+        self.repr.repr(float('nan'))
+        self.assertEqual(2, len(self.repr._cache))
+        self.assertEqual('-0.0', self.repr.repr(-0.0))
+
+    def test_report_call(self):
+        tracer = tracerlib.StackTracer(ListSink())
+        tracer.watch('testmod.A.m2')
+        with tracerlib.TracerManager(tracer):
+            testmod.A().m2(list(range(1000)), 'a\nb')
+        self.assertEqual("testmod.A.m2(<testmod.A object", tracer.sink.lines[0][:30])
+        self.assertTrue(tracer.sink.lines[0].endswith(
+            ", [0, 1, 2, 3, 4, 5, 6, 7, ...], 'a\\nb')"), tracer.sink.lines[0])
+        tracer.report_call('f', (1,), collections.OrderedDict([('a', 'x'), ('b', 2)]))
+        self.assertEqual("f(1, a='x', b=2)", tracer.sink.lines[-1])
+
+
+class CallGraphTracerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tracer = tracerlib.CallGraphTracer()
+        self.tracer.watch('testmod.*')
+        with tracerlib.TracerManager(self.tracer):
+            testmod.a()
+            testmod.a()
+        self.a = tracerlib.code_info(testmod.a.__code__).serial
+        self.b = tracerlib.code_info(testmod.b.__code__).serial
+
+    def test_counts(self):
+        stacks = self.tracer.stacks
+        self.assertEqual([(self.a,), (self.a, self.b)], sorted(stacks))
+        self.assertEqual([2, 2], [calls for calls, ns in stacks.values()])
+        self.assertEqual([(self.a, self.b)], list(self.tracer.edges))
+        self.assertEqual(2, self.tracer.edges[self.a, self.b][0])
+        self.assertEqual('testmod.b', self.tracer.names[self.b][0])
+
+    def test_arguments_not_read(self):
+        tracer = tracerlib.CallGraphTracer()
+        tracer.watch('testmod.A.*')
+        with mock.patch.object(tracerlib.FrameInspector, 'all_arg_values') as values:
+            with tracerlib.TracerManager(tracer):
+                testmod.A().m2(1, 2)
+        values.assert_not_called()
+        self.assertEqual(1, len(tracer.stacks))
+
+    def test_write_collapsed(self):
+        out = StringIO()
+        self.tracer.write_collapsed(out)
+        self.assertEqual('testmod.a 2\ntestmod.a;testmod.b 2\n', out.getvalue())
+        out = StringIO()
+        self.tracer.write_collapsed(out, weight='time')
+        self.assertEqual(['testmod.a', 'testmod.a;testmod.b'],
+                         [line.split()[0] for line in out.getvalue().splitlines()])
+        self.assertRaises(ValueError, self.tracer.write_collapsed, out, weight='bytes')
+
+    def test_write_callgrind(self):
+        out = StringIO()
+        self.tracer.write_callgrind(out)
+        lines = out.getvalue().splitlines()
+        self.assertEqual('# callgrind format', lines[0])
+        self.assertIn('fn=(%d) testmod.a' % self.a, lines)
+        # Only the first use of a name gives it in full
+        self.assertEqual(1, len([line for line in lines if line.endswith('=(%d) testmod.b' % self.b)]))
+        self.assertTrue(set(['cfn=(%d)' % self.b, 'cfn=(%d) testmod.b' % self.b]) & set(lines))
+        self.assertIn('calls=2 %d' % testmod.b.__code__.co_firstlineno, lines)
+        self.assertEqual(1, len([line for line in lines if line.startswith('fl=(1) ')]))
+
+
+def trace_in_process(sink):
+    tracer = tracerlib.StackTracer(sink)
+    tracer.watch('testmod.a')
+    with tracerlib.TracerManager(tracer):
+        testmod.a()
+
+
+class ProcessFileSinkTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.sink = tracerlib.ProcessFileSink(self.dir, prefix='t')
+
+    def tearDown(self):
+        self.sink.close()
+        shutil.rmtree(self.dir)
+
+    def paths(self):
+        return sorted(os.path.join(self.dir, name) for name in os.listdir(self.dir))
+
+    def test_file_per_process(self):
+        self.sink.write('one')
+        self.sink.close()
+        self.assertEqual(['t-%d' % os.getpid()],
+                         [os.path.basename(path).rsplit('-', 1)[0] for path in self.paths()])
+        header, lines = tracerlib.read_process_trace(self.sink.path)
+        self.assertEqual(os.getpid(), header['pid'])
+        self.assertEqual(['one'], [line for timestamp, line in lines])
+
+    @unittest.skipIf(not hasattr(os, 'fork'), "requires os.fork")
+    def test_reopened_after_fork(self):
+        self.sink.write('parent')
+        pid = os.fork()
+        if pid == 0:
+            self.sink.write('child')
+            self.sink.close()
+            os._exit(0)
+        os.waitpid(pid, 0)
+        self.sink.write('parent again')
+        self.sink.close()
+        lines = {}
+        for path in self.paths():
+            header, records = tracerlib.read_process_trace(path)
+            lines[header['pid']] = [line for timestamp, line in records]
+        self.assertEqual({os.getpid(): ['parent', 'parent again'], pid: ['child']}, lines)
+
+    @unittest.skipIf(not hasattr(multiprocessing, 'get_context'), "requires multiprocessing contexts")
+    def test_multiprocessing_worker(self):
+        process = multiprocessing.get_context('fork').Process(
+            target=trace_in_process, args=(self.sink,))
+        process.start()
+        process.join()
+        trace_in_process(self.sink)
+        self.sink.close()
+        out = StringIO()
+        tracerlib.merge_process_traces(self.paths(), out)
+        lines = out.getvalue().splitlines()
+        self.assertEqual(['%d testmod.a()' % process.pid, '%d return None' % process.pid,
+                          '%d testmod.a()' % os.getpid(), '%d return None' % os.getpid()],
+                         lines)
+
+    def test_summary(self):
+        for line in ('a', 'b', 'c'):
+            self.sink.write(line)
+        self.sink.close()
+        out = StringIO()
+        tracerlib.summarize_process_traces(self.paths(), out)
+        lines = out.getvalue().splitlines()
+        self.assertEqual(2, len(lines))
+        self.assertEqual([str(os.getpid()), '3'], lines[1].split('\t')[::2][:2])
+
+
+class BinaryTracerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.out = io.BytesIO()
+        self.tracer = tracerlib.BinaryTracer(self.out, watch=['testmod.*'])
+        with tracerlib.TracerManager(self.tracer):
+            testmod.a()
+            testmod.a()
+        self.out.seek(0)
+
+    def test_records(self):
+        records = list(tracerlib.read_binary_trace(self.out))
+        self.assertEqual(8, len(records))
+        self.assertEqual(['call', 'call', 'return', 'return'], [r.event for r in records[:4]])
+        self.assertEqual(['testmod.a', 'testmod.b', 'testmod.b', 'testmod.a'],
+                         [r.qual_name for r in records[:4]])
+        self.assertEqual([1, 2, 2, 1], [r.depth for r in records[:4]])
+        timestamps = [r.timestamp for r in records]
+        self.assertEqual(sorted(timestamps), timestamps)
+
+    def test_names_written_once(self):
+        data = self.out.getvalue()
+        self.assertEqual(1, data.count(b'testmod.b'))
+
+    def test_decode_outline(self):
+        out = StringIO()
+        tracerlib.decode_outline(self.out, out)
+        self.assertEqual(['testmod.a()', ' testmod.b()', ' return', 'return'],
+                         out.getvalue().splitlines()[:4])
+
+    def test_no_line_events(self):
+        self.assertRaises(ValueError, tracerlib.BinaryTracer, io.BytesIO(), events=['line'])
+
+    def test_deep_stack(self):
+        out = io.BytesIO()
+        tracer = tracerlib.BinaryTracer(out, watch=['testmod.*'])
+        tracer._thread_state.current().depth = 0xffff
+        with tracerlib.TracerManager(tracer):
+            testmod.a()
+        out.seek(0)
+        records = list(tracerlib.read_binary_trace(out))
+        self.assertEqual([0xffff] * 4, [r.depth for r in records])
+
+    def test_generator(self):
+        out = io.BytesIO()
+        with tracerlib.TracerManager(tracerlib.BinaryTracer(out, watch=['testmod.g'])):
+            list(testmod.g())
+        out.seek(0)
+        self.assertEqual(['call', 'suspend', 'resume', 'suspend', 'resume', 'return'],
+                         [r.event for r in tracerlib.read_binary_trace(out)])
+        out.seek(0)
+        outline = StringIO()
+        tracerlib.decode_outline(out, outline)
+        self.assertEqual(['testmod.g()', 'return'], outline.getvalue().splitlines())
+
+    @unittest.skipIf(testasync is None, "requires asyncio")
+    def test_task_depths(self):
+        out = io.BytesIO()
+        with tracerlib.TracerManager(tracerlib.BinaryTracer(out, watch=['testasync.*'])):
+            asyncio.run(testasync.workers())
+        out.seek(0)
+        depths = collections.defaultdict(set)
+        for record in tracerlib.read_binary_trace(out):
+            depths[record.qual_name].add(record.depth)
+        self.assertEqual({'testasync.workers': set([1]), 'testasync.worker': set([1]),
+                          'testasync.step': set([2])}, dict(depths))
+
+
+class StackSamplerTestCase(unittest.TestCase):
+
+    def test_thread_sampling(self):
+        with tracerlib.StackSampler(interval=0.001) as sampler:
+            testmod.spin(0.2)
+        self.assertTrue(sampler.samples)
+        spinning = [stack for stack in sampler.counts if stack[-1] == 'testmod.spin']
+        self.assertTrue(spinning)
+        self.assertEqual('test.StackSamplerTestCase.test_thread_sampling', spinning[0][-2])
+
+    @unittest.skipIf(not hasattr(signal, 'setitimer'), "requires signal.setitimer")
+    def test_signal_sampling(self):
+        with tracerlib.StackSampler(interval=0.001, mode='signal') as sampler:
+            testmod.spin(0.2)
+        self.assertTrue(sampler.samples)
+        self.assertTrue(any(stack[-1] == 'testmod.spin' for stack in sampler.counts))
+
+    def test_write_collapsed(self):
+        sampler = tracerlib.StackSampler()
+        sampler.counts[('testmod.a', 'testmod.b')] = 3
+        out = StringIO()
+        sampler.write_collapsed(out)
+        self.assertEqual('testmod.a;testmod.b 3\n', out.getvalue())
+
+
 ONE_BLOCK = """
 foo:1
 bar:2
@@ -299,6 +1517,43 @@ class ConfigLoaderTestCase(unittest.TestCase):
         self.assertIs(tm.tracers[0], tm.tracers[1].parent)
         self.assertIs(tm.tracers[2], tm.tracers[3].parent)
 
+    def test_tree(self):
+        tm = self.loader.loads(UNNESTING)
+        tree = tm._dispatch_index().tree
+        self.assertEqual([(tm.tracers[0], [(tm.tracers[1], [])]),
+                          (tm.tracers[2], [(tm.tracers[3], [])])], tree)
+
+    def test_children_only_while_parent_in_call(self):
+        tm = self.loader.loads('match:testmod.a\n    match:testmod.b\n')
+        parent, child = tm.tracers
+        child.dispatch = mock.Mock(return_value=True)
+        with tm:
+            testmod.b()
+            child.dispatch.assert_not_called()
+            testmod.a()
+        self.assertEqual(['call', 'line', 'return'],
+                         [c[0][1] for c in child.dispatch.call_args_list])
+
+    def test_parent_catching_exception(self):
+        tm = self.loader.loads('match:testmod.catches\n    match:testmod.b\n')
+        parent, child = tm.tracers
+        child.dispatch = mock.Mock(return_value=True)
+        with tm:
+            testmod.catches()
+            self.assertEqual(0, parent.incall)
+            testmod.b()
+        # Only for the call to b() after catching the exception
+        self.assertEqual(['call', 'line', 'return'],
+                         [c[0][1] for c in child.dispatch.call_args_list])
+
+    def test_lines_only_in_active_subtree(self):
+        parent = tracerlib.Tracer(events=['call'], watch=['testmod.a'])
+        child = tracerlib.Tracer(events=['line'], watch=['testmod.f'], parent=parent)
+        tm = tracerlib.TracerManager(parent, child)
+        self.assertFalse(tm._trace(testmod.f(), 'call', None))
+        parent.incall = 1
+        self.assertTrue(tm._trace(testmod.f(), 'call', None))
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,25 @@
+import asyncio
+
+
+async def step(n):
+    await asyncio.sleep(0)
+    return n
+
+async def worker(n):
+    await step(n)
+    return n
+
+async def workers():
+    return await asyncio.gather(worker(1), worker(2))
+
+async def sleeper(seconds):
+    await asyncio.sleep(seconds)
+
+def delegate():
+    yield 0
+    result = yield from delegated()
+    return result
+
+def delegated():
+    yield 1
+    return 2
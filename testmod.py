@@ -26,3 +26,26 @@ def a():
 def b():
     pass
 
+
+def r():
+    raise ValueError('r')
+
+def c():
+    return len([])
+
+def spin(seconds):
+    import time
+    end = time.time() + seconds
+    while time.time() < end:
+        pass
+
+def g():
+    yield 1
+    yield 2
+
+def catches():
+    try:
+        r()
+    except ValueError:
+        pass
+    b()
@@ -32,35 +32,546 @@ import sys, os
 import re
 import inspect
 import collections
+import dis
+import heapq
+import itertools
+import json
+import logging
 import traceback
-
+import threading
+import atexit
+import random
+import signal
+import struct
+import time
+import types
+import weakref
+
+try:
+    from threading import get_ident as _get_ident
+except ImportError:
+    from thread import get_ident as _get_ident
+
+try:
+    basestring
+except NameError:
+    basestring = str
+
+try:
+    import reprlib
+except ImportError:
+    # Python 2
+    import repr as reprlib
+
+try:
+    _clock_ns = time.perf_counter_ns
+except AttributeError:
+    _clock = getattr(time, 'perf_counter', time.time)
+    def _clock_ns():
+        return int(_clock() * 1e9)
+
+try:
+    _wall_clock_ns = time.time_ns
+except AttributeError:
+    def _wall_clock_ns():
+        return int(time.time() * 1e9)
+
+try:
+    _cpu_clock_ns = time.thread_time_ns
+except AttributeError:
+    _cpu_clock = getattr(time, 'thread_time', getattr(time, 'clock', time.time))
+    def _cpu_clock_ns():
+        return int(_cpu_clock() * 1e9)
+
+try:
+    _process_clock_ns = time.process_time_ns
+except AttributeError:
+    _process_clock = getattr(time, 'process_time', getattr(time, 'clock', time.time))
+    def _process_clock_ns():
+        return int(_process_clock() * 1e9)
+
+# sys.monitoring (PEP 669) is only available from Python 3.12
+_monitoring = getattr(sys, 'monitoring', None)
+
+
+_log = logging.getLogger('tracerlib')
 
 _global_tracer_manager = None
 _global_env_tracer = False
 _active_managers = []
+# Bumped whenever tracers or their events change, so managers know to
+# rebuild their dispatch index
+_tracing_versions = itertools.count()
+_tracing_version = next(_tracing_versions)
+
+def _dispatch(frame, event, arg, fi):
+    """Dispatch an event to all the active managers.
+
+    Returns whether any of them needs the rest of the frame's events.
+    """
 
-def _protected_trace_func(func):
-    def _(*args, **kwargs):
+    local = False
+    for tm in _active_managers:
         try:
-            return func(*args, **kwargs)
+            if tm._trace(frame, event, arg, fi):
+                local = True
         except Exception:
             traceback.print_exc()
+    return local
+
+# The idents of tracerlib's own threads, which are never traced
+_internal_threads = set()
+
+def _start_internal_thread(target, name):
+    """Start a daemon thread to run ``target``, which is never traced."""
+
+    def run():
+        _internal_threads.add(_get_ident())
+        sys.settrace(None)
+        sys.setprofile(None)
+        try:
+            target()
+        finally:
+            _internal_threads.discard(_get_ident())
+    thread = threading.Thread(target=run, name=name)
+    thread.daemon = True
+    thread._tracerlib_internal = True
+    thread.start()
+    return thread
+
+# Objects with ``_before_fork()`` and ``_after_fork()`` methods, to keep
+# their threads and files right in both processes after a fork
+_fork_handlers = weakref.WeakSet()
+
+def _before_fork():
+    for obj in list(_fork_handlers):
+        obj._before_fork()
+
+def _after_fork():
+    # The threads of the parent don't exist in the child
+    _internal_threads.clear()
+    for obj in list(_fork_handlers):
+        obj._after_fork()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(before=_before_fork, after_in_child=_after_fork)
+
+def _thread_hook(install, func):
+    """Make a hook for ``threading.settrace`` or ``threading.setprofile``,
+    which installs ``func`` in each thread at its first event, unless the
+    thread is one of tracerlib's own.
+    """
+
+    def hook(frame, event, arg):
+        if getattr(threading.current_thread(), '_tracerlib_internal', False):
+            install(None)
             return None
-    return _
+        install(func)
+        return func(frame, event, arg)
+    return hook
+
+def _settrace_threads(func):
+    """Install a trace function in the current thread, threads started later
+    and, from Python 3.12, threads which are already running.
+    """
+
+    hook = _thread_hook(sys.settrace, func) if func is not None else None
+    if hasattr(threading, 'settrace_all_threads'):
+        threading.settrace_all_threads(hook)
+    else:
+        threading.settrace(hook)
+    sys.settrace(func)
+
+def _setprofile_threads(func):
+    """Like ``_settrace_threads()``, for a profile function."""
+
+    hook = _thread_hook(sys.setprofile, func) if func is not None else None
+    if hasattr(threading, 'setprofile_all_threads'):
+        threading.setprofile_all_threads(hook)
+    else:
+        threading.setprofile(hook)
+    sys.setprofile(func)
 
 def _global_tracer(frame, event, arg):
     # Can be None during termination
     if _active_managers:
+        fi = FrameInspector(frame)
+        # Frames no tracer is interested in don't need line, return or
+        # exception events at all.
+        if _dispatch(frame, event, arg, fi):
+            return _FrameTracer(fi)
+    return None
+
+
+class _FrameTracer(object):
+    """The local trace function of a single frame, so all of its events share
+    one ``FrameInspector``.
+    """
+
+    __slots__ = ('fi',)
+
+    def __init__(self, fi):
+        self.fi = fi
+
+    def __call__(self, frame, event, arg):
+        if _active_managers:
+            if event == 'exception':
+                self.fi.unwinding = True
+            elif event == 'line':
+                self.fi.unwinding = False
+            _dispatch(frame, event, arg, self.fi)
+            return self
+        return None
+
+
+_c_events = frozenset(['c_call', 'c_return', 'c_exception'])
+# All the events a tracer can be given
+_all_events = frozenset([
+    'call', 'return', 'line', 'exception', 'c_call', 'c_return', 'c_exception',
+])
+# The events tracers get when they don't give a list of events
+_default_events = _all_events - _c_events
+# The events sys.setprofile delivers
+_profile_events = frozenset(['call', 'return', 'c_call', 'c_return', 'c_exception'])
+# The callables sys.setprofile reports c_* events for
+_c_function_types = (types.BuiltinFunctionType, type(str.join))
+
+def _c_profiler(frame, event, arg):
+    # Used along with sys.settrace, which delivers all the other events
+    if event in _c_events and _active_managers:
+        # Share the inspector of a frame with a local trace function, which
+        # holds the sampling decisions made at its call
+        local = frame.f_trace
+        fi = local.fi if isinstance(local, _FrameTracer) else FrameInspector(frame)
+        _dispatch(frame, event, arg, fi)
+
+def _tracing_needs():
+    """Collect the events needed by all the active tracers, and whether any
+    of them is a plain trace function which expects ``sys.settrace``.
+    """
+
+    needs = set()
+    plain = False
+    for tm in _active_managers:
+        index = tm._dispatch_index()
+        needs.update(index.needs)
+        plain = plain or index.plain
+    return needs, plain
+
+
+class _SettraceBackend(object):
+    """Delivers events with ``sys.settrace``."""
+
+    name = 'settrace'
+
+    @classmethod
+    def available(cls, needs, plain):
+        return True
+
+    def __init__(self):
+        self._c_profiler = None
+
+    def start(self, needs):
+        self.refresh(needs)
+        _settrace_threads(_global_tracer)
+
+    def refresh(self, needs, widened=False):
+        # sys.settrace never delivers C function events
+        c_profiler = _c_profiler if _c_events.intersection(needs) else None
+        if c_profiler is not self._c_profiler:
+            self._c_profiler = c_profiler
+            _setprofile_threads(c_profiler)
+
+    def stop(self):
+        _settrace_threads(None)
+        if self._c_profiler is not None:
+            _setprofile_threads(None)
+
+
+class _ProfileBackend(object):
+    """Delivers events with ``sys.setprofile``, when the tracers only need
+    call, return and C function events. No line events are generated at all.
+    """
+
+    name = 'profile'
+
+    @classmethod
+    def available(cls, needs, plain):
+        return not plain and needs <= _profile_events
+
+    def __init__(self):
+        # The inspectors of the frames which are being traced
+        self._frames = {}
+
+    def start(self, needs):
+        _setprofile_threads(self._profile)
+
+    def refresh(self, needs, widened=False):
+        pass
+
+    def stop(self):
+        _setprofile_threads(None)
+        self._frames.clear()
+
+    def _profile(self, frame, event, arg):
+        # Can be None during termination
+        if not _active_managers:
+            return
+        if event == 'call':
+            fi = FrameInspector(frame)
+            if _dispatch(frame, event, arg, fi):
+                self._frames[frame] = fi
+        elif event == 'return':
+            # Like sys.settrace, only frames which a tracer needed after their
+            # call event get a return event
+            fi = self._frames.pop(frame, None)
+            if fi is not None:
+                _dispatch(frame, event, arg, fi)
+        else:
+            fi = self._frames.get(frame)
+            if fi is None:
+                fi = FrameInspector(frame)
+            _dispatch(frame, event, arg, fi)
+
+
+class _MonitoringBackend(object):
+    """Delivers events with ``sys.monitoring``, in all threads.
+
+    Only the event types the tracers ask for are registered, line events are
+    only turned on for code objects a tracer watches, and locations which no
+    tracer watches are disabled. They are enabled again when the code a
+    tracer could watch grows, by ``sys.monitoring.restart_events()``, which
+    also enables again the locations every other tool has disabled.
+    """
+
+    name = 'monitoring'
+    tool_id = getattr(_monitoring, 'DEBUGGER_ID', None)
+    # Whether any location was disabled since the last restart. Kept by the
+    # class, as locations stay disabled after the tool id is freed
+    disabled = False
+
+    @classmethod
+    def available(cls, needs, plain):
+        # Plain trace functions get the events exactly as sys.settrace
+        # delivers them, so only use monitoring when all tracers are Tracers
+        if _monitoring is None or plain:
+            return False
+        return _monitoring.get_tool(cls.tool_id) in (None, 'tracerlib')
+
+    def __init__(self):
+        self.started = False
+        self.lines = False
+        self.returns = False
+        self._line_codes = {}
+        # The inspectors of the frames which are being traced
+        self._frames = {}
+
+    def _callbacks(self):
+        E = _monitoring.events
+        return [
+            (E.PY_START, self._on_start),
+            (E.PY_RESUME, self._on_resume),
+            (E.PY_THROW, self._on_throw),
+            (E.PY_RETURN, self._on_return),
+            (E.PY_YIELD, self._on_yield),
+            (E.PY_UNWIND, self._on_unwind),
+            (E.RAISE, self._on_raise),
+            (E.LINE, self._on_line),
+            (E.CALL, self._on_c_call),
+            (E.C_RETURN, self._on_c_return),
+            (E.C_RAISE, self._on_c_raise),
+        ]
+
+    def _event_set(self, needs):
+        E = _monitoring.events
+        events = 0
+        if 'call' in needs or _local_events.intersection(needs):
+            # Frames get their other events, and line events are turned on
+            # for a code object, when they are called
+            events |= E.PY_START | E.PY_RESUME | E.PY_THROW
+        if _local_events.intersection(needs) or _c_events.intersection(needs):
+            # Also when only other events within frames are needed, to forget
+            # the frames kept for them when they return
+            events |= E.PY_RETURN | E.PY_YIELD | E.PY_UNWIND
+        if 'exception' in needs:
+            events |= E.RAISE
+        if _c_events.intersection(needs):
+            # CALL, C_RETURN and C_RAISE can only be set together. Each C
+            # function event is still only given to the tracers which take it
+            events |= E.CALL | E.C_RETURN | E.C_RAISE
+        return events
+
+    def start(self, needs):
+        if not self.started:
+            self.started = True
+            _monitoring.use_tool_id(self.tool_id, 'tracerlib')
+            for event, callback in self._callbacks():
+                _monitoring.register_callback(self.tool_id, event, callback)
+        # A manager starting brings its tracers' rules
+        self.refresh(needs, True)
+
+    def refresh(self, needs, widened=False):
+        self.lines = 'line' in needs
+        self.returns = 'return' in needs
+        _monitoring.set_events(self.tool_id, self._event_set(needs))
+        if widened and _MonitoringBackend.disabled:
+            # Re-enable the locations disabled under the old rules
+            _MonitoringBackend.disabled = False
+            _monitoring.restart_events()
+
+    def stop(self):
+        _monitoring.set_events(self.tool_id, 0)
+        for ref in self._line_codes.values():
+            code = ref()
+            if code is not None:
+                _monitoring.set_local_events(self.tool_id, code, 0)
+        self._line_codes.clear()
+        for event, callback in self._callbacks():
+            _monitoring.register_callback(self.tool_id, event, None)
+        _monitoring.free_tool_id(self.tool_id)
+        self.started = False
+        self._frames.clear()
+
+    def _enable_lines(self, code):
+        key = id(code)
+        if key not in self._line_codes:
+            lines = self._line_codes
+            self._line_codes[key] = weakref.ref(code, lambda ref: lines.pop(key, None))
+            _monitoring.set_local_events(self.tool_id, code, _monitoring.events.LINE)
+
+    def _watched(self, fi):
         for tm in _active_managers:
-            f = _protected_trace_func(tm._trace)
-            f(frame, event, arg)
-    return _global_tracer
+            if tm._code_watched(fi):
+                return True
+        return False
+
+    def _dispatch(self, frame, event, arg, can_disable=True, switch=False):
+        # ``switch`` is whether a call resumes, or a return suspends
+        if not _active_managers:
+            return None
+        if event == 'call':
+            fi = FrameInspector(frame)
+            fi._resumed = switch
+        elif event in _c_events:
+            fi = self._frames.get(frame)
+            if fi is None:
+                fi = FrameInspector(frame)
+        else:
+            if event == 'return':
+                fi = self._frames.pop(frame, None)
+                if fi is not None and not self.returns:
+                    # Only delivered to forget the frame
+                    return None
+            else:
+                fi = self._frames.get(frame)
+            if fi is None:
+                # Like sys.settrace, only frames which a tracer needed after
+                # their call event get the rest of their events
+                if can_disable and not self._watched(FrameInspector(frame)):
+                    _MonitoringBackend.disabled = True
+                    return _monitoring.DISABLE
+                return None
+        if event == 'return':
+            fi._suspended = switch
+        if not self._watched(fi):
+            if not can_disable:
+                return None
+            _MonitoringBackend.disabled = True
+            return _monitoring.DISABLE
+        if _dispatch(frame, event, arg, fi) and event == 'call':
+            self._frames[frame] = fi
+            if self.lines:
+                self._enable_lines(frame.f_code)
+        return None
+
+    def _on_start(self, code, offset):
+        if _get_ident() not in _internal_threads:
+            return self._dispatch(sys._getframe(1), 'call', None)
+
+    def _on_resume(self, code, offset):
+        if _get_ident() not in _internal_threads:
+            return self._dispatch(sys._getframe(1), 'call', None, switch=True)
+
+    def _on_throw(self, code, offset, exc):
+        if _get_ident() not in _internal_threads:
+            self._dispatch(sys._getframe(1), 'call', None, False, True)
+
+    def _on_return(self, code, offset, retval):
+        if _get_ident() not in _internal_threads:
+            return self._dispatch(sys._getframe(1), 'return', retval)
+
+    def _on_yield(self, code, offset, retval):
+        if _get_ident() not in _internal_threads:
+            return self._dispatch(sys._getframe(1), 'return', retval, switch=True)
+
+    def _on_unwind(self, code, offset, exc):
+        if _get_ident() not in _internal_threads:
+            self._dispatch(sys._getframe(1), 'return', None, False)
+
+    def _on_raise(self, code, offset, exc):
+        if _get_ident() not in _internal_threads:
+            arg = (type(exc), exc, exc.__traceback__)
+            self._dispatch(sys._getframe(1), 'exception', arg, False)
+
+    def _on_line(self, code, line_number):
+        if _get_ident() not in _internal_threads:
+            return self._dispatch(sys._getframe(1), 'line', None)
+
+    def _on_c_call(self, code, offset, callable, arg0):
+        # CALL is also raised for calls to Python functions
+        if isinstance(callable, _c_function_types) and _get_ident() not in _internal_threads:
+            return self._dispatch(sys._getframe(1), 'c_call', callable)
+
+    def _on_c_return(self, code, offset, callable, arg0):
+        if isinstance(callable, _c_function_types) and _get_ident() not in _internal_threads:
+            self._dispatch(sys._getframe(1), 'c_return', callable, False)
+
+    def _on_c_raise(self, code, offset, callable, arg0):
+        if isinstance(callable, _c_function_types) and _get_ident() not in _internal_threads:
+            self._dispatch(sys._getframe(1), 'c_exception', callable, False)
+
+
+# In order of preference, the cheapest first
+_backends = [_MonitoringBackend, _ProfileBackend, _SettraceBackend]
+_backend = None
 
 def _start_tracing():
-    sys.settrace(_global_tracer)
+    """Start tracing in all threads, choosing the cheapest backend which can
+    deliver the events all the active tracers need.
+    """
+
+    global _backend
+    needs, plain = _tracing_needs()
+    for backend in _backends:
+        if backend.available(needs, plain):
+            break
+    if _backend is not None and type(_backend) is not backend:
+        _backend.stop()
+        _backend = None
+    if _backend is None:
+        _backend = backend()
+    _backend.start(needs)
 
 def _stop_tracing():
-    sys.settrace(None)
+    global _backend
+    if _backend is not None:
+        _backend.stop()
+        _backend = None
+
+def _tracing_changed(widened=False):
+    """Update the active backend after tracers or their rules change.
+    ``widened`` is whether code which no tracer watched may now be watched.
+    """
+
+    global _tracing_version
+    _tracing_version = next(_tracing_versions)
+    if _backend is None or not _active_managers:
+        return
+    needs, plain = _tracing_needs()
+    if type(_backend).available(needs, plain):
+        _backend.refresh(needs, widened)
+    else:
+        _start_tracing()
 
 def addtracer(tracer):
     """Add a trace function to the global manager."""
@@ -82,6 +593,54 @@ def removetracer(tracer):
         _global_tracer_manager.stop()
 
 
+TracerStats = collections.namedtuple(
+    'TracerStats', 'tracer dispatched rejected errors time_ns')
+
+
+# The events a tracer scaled down to keep to a budget still gets
+_budget_events = frozenset(['call', 'return', 'exception'])
+
+# The tracers of a TracerManager, as a ``tree`` of (tracer, children) from
+# their parents, and the ``events`` each takes. ``frame_tracers`` are those
+# which could want the events within a frame after its call, and ``plain``
+# is whether there are plain trace functions, which always do. ``codes``
+# caches, by code serial, the tracers passed for each code and their trees
+_DispatchIndex = collections.namedtuple(
+    '_DispatchIndex', 'version tree events frame_tracers plain needs watch codes')
+
+def _prune_tree(nodes, take):
+    """The nodes of a tracer tree as (tracer, taken, subtree), leaving out
+    the subtrees without any tracer for which ``take(tracer)`` is true.
+    """
+
+    pruned = []
+    for tracer, children in nodes:
+        subtree = _prune_tree(children, take)
+        taken = take(tracer)
+        if taken or subtree:
+            pruned.append((tracer, taken, subtree))
+    return pruned
+
+
+class _ThreadDicts(threading.local):
+    """Dicts which each thread has its own of, as attributes named by
+    ``names``, so no lock is needed to update them. Each thread's dicts are
+    appended to ``all_dicts`` as a tuple, as other threads see their own
+    attributes, for the counts of all the threads to be merged.
+    """
+
+    def __init__(self, all_dicts, *names):
+        dicts = tuple({} for name in names)
+        for name, d in zip(names, dicts):
+            setattr(self, name, d)
+        all_dicts.append(dicts)
+
+
+def _report_tracer_error(tracer):
+    print("Failed tracer %r" % (tracer,), file=sys.stderr)
+    traceback.print_exc()
+
+
 class TracerManager(object):
     """Maintains a stack of tracers to enable and disable.
 
@@ -93,15 +652,71 @@ class TracerManager(object):
             # some
             # code
             # to trace
+
+    With ``stats=True``, it counts the events it receives and what each
+    tracer does with them, and times the tracers, for ``stats()`` to report.
+
+    ``budget`` limits the overhead of the tracers to a fraction of the wall
+    time, such as ``0.05`` for 5%, measured every ``budget_interval``
+    seconds by a thread of the manager's own. While the tracers take more,
+    the most expensive one is scaled down a step at a time: to tracing one
+    in ``budget_sample`` calls, then to ``call``, ``return`` and
+    ``exception`` events only, then suspended. While they take less than
+    half of it, the steps are undone, the latest first, and a tracer which
+    missed returns meanwhile is ``reset()``. As a step takes away the cost
+    it measures, a step is only undone once the share measured before it,
+    scaled by how busy the process is now compared to then, is also less
+    than half of the budget, so a steady load doesn't flip a tracer back
+    and forth. The changes are logged to the ``tracerlib`` logger, and all
+    undone when the manager stops. A budget implies ``stats=True``.
+
+    Each event is only given to the tracers whose ``events`` include its
+    type, and whose ``match:`` rules pass for its function, from lists built
+    when the tracers or their rules change and narrowed once for each code
+    object. So the cost of an event does not grow with the number of
+    tracers which turn it down.
+
+    Tracers whose ``parent`` is one of the manager's tracers, like those
+    nested in a ``ConfigLoader`` file, are only considered while the parent
+    is in a call, so a nested tree of tracers costs nothing outside the
+    calls which activate it, and the frames which get line events are only
+    those within an active subtree.
     """
 
-    def __init__(self, *tracers):
+    def __init__(self, *tracers, **kwargs):
+        self.budget = kwargs.pop('budget', None)
+        self.budget_interval = kwargs.pop('budget_interval', 1.0)
+        self.budget_sample = kwargs.pop('budget_sample', 10)
+        stats = kwargs.pop('stats', False) or self.budget is not None
+        if kwargs:
+            raise TypeError("Unexpected arguments: %s" % ', '.join(sorted(kwargs)))
         self.tracers = list(tracers)
+        self._all_stats = []
+        # The events received of each type, and [dispatched, rejected, errors,
+        # time_ns] for each tracer
+        self._stats = _ThreadDicts(self._all_stats, 'events', 'tracers') if stats else None
+        self._suspended = set()
+        # The steps taken to keep to the budget, in order, as (tracer, step,
+        # saved, share, busy), where saved is the tracer's events before a
+        # 'calls' step, and share and busy were measured before the step
+        self._budget_steps = []
+        self._budget_lock = threading.Lock()
+        self._budget_start = None
+        self._budget_spent = 0
+        self._budget_cpu = 0
+        # The time_ns of each tracer at the last check
+        self._budget_times = {}
+        self._budget_stopped = None
+        self._budget_thread = None
+        self._index = None
 
     def add(self, tracer):
         """Add a tracer function to be managed."""
 
         self.tracers.append(tracer)
+        self._index = None
+        if self in _active_managers:
+            _tracing_changed(True)
 
     def remove(self, tracer):
         """Remove a tracer function."""
@@ -110,20 +725,271 @@ class TracerManager(object):
             if t is tracer:
                 del self.tracers[i]
                 break
+        self._index = None
+        if self in _active_managers:
+            _tracing_changed()
 
-    def _trace(self, frame, event, arg):
-        drop = []
-        for i, tracer in enumerate(self.tracers):
-            try:
-                tracer(frame, event, arg)
-            except BaseException as e:
-                exc_type, exc_value, exc_traceback = sys.exc_info()
-                print("Failed tracer %r" % (tracer,), file=sys.stderr)
-                traceback.print_exc()
-                #drop.append(i)
-        drop.reverse()
-        for i in drop:
-            del self.tracers[i]
+    def _dispatch_index(self):
+        """The tree of the tracers and the events each takes, rebuilt if the
+        tracers or their events changed since it was built.
+        """
+
+        index = self._index
+        if index is not None and index.version == _tracing_version:
+            return index
+        version = _tracing_version
+        tracers = [tracer for tracer in self.tracers if tracer not in self._suspended]
+        events = {}
+        frame_tracers = set()
+        needs = set()
+        plain = False
+        nodes = {}
+        tree = []
+        for tracer in tracers:
+            if not hasattr(tracer, 'traces_frame'):
+                # Plain trace functions get the events sys.settrace delivers
+                plain = True
+                events[tracer] = _default_events
+                needs.update(_default_events)
+            else:
+                events[tracer] = _default_events if tracer.events is None else tracer.events
+                needs.update(events[tracer])
+                if _local_events.intersection(events[tracer]) or (
+                        getattr(tracer, '_frame_rules', None) and
+                        _c_events.intersection(events[tracer])):
+                    frame_tracers.add(tracer)
+            nodes[tracer] = (tracer, [])
+        for tracer in tracers:
+            # Children are only given events while their parent is in a call
+            parent = nodes.get(getattr(tracer, 'parent', None))
+            if parent is None:
+                tree.append(nodes[tracer])
+            else:
+                parent[1].append(nodes[tracer])
+        index = self._index = _DispatchIndex(version, tree, events, frame_tracers, plain,
+                                             needs, _WatchIndex(tracers), _CodeCache())
+        return index
+
+    def _code_tracers(self, index, fi, event):
+        """The tree of the tracers to give an event in the frame to, or of
+        those which could want the events within it for ``None``, leaving
+        out those whose static rules turn down the frame's code.
+        """
+
+        info = fi.code_info
+        cached = index.codes.get(info.serial)
+        if cached is None:
+            cached = index.codes[info.serial] = (index.watch.tracers(info.qual_name), {})
+        passed, by_event = cached
+        try:
+            return by_event[event]
+        except KeyError:
+            pass
+        if event is None:
+            take = lambda tracer: tracer in passed and tracer in index.frame_tracers
+        else:
+            take = lambda tracer: tracer in passed and event in index.events[tracer]
+        tree = by_event[event] = _prune_tree(index.tree, take)
+        return tree
+
+    def _trace(self, frame, event, arg, fi=None):
+        """Dispatch an event to the tracers which take its type.
+
+        ``Tracer`` instances share the frame's ``FrameInspector``, ``fi``, so
+        anything it computes is only computed once per frame. For ``call``
+        events, returns whether any tracer needs the rest of the events in
+        the frame. Tracers which don't provide ``traces_frame()`` always get
+        them.
+        """
+
+        stats = self._stats
+        if stats is not None:
+            events = stats.events
+            events[event] = events.get(event, 0) + 1
+        index = self._index
+        if index is None or index.version != _tracing_version:
+            index = self._dispatch_index()
+        if fi is None:
+            fi = FrameInspector(frame)
+        self._trace_tree(self._code_tracers(index, fi, event), frame, event, arg, fi,
+                         None if stats is None else stats.tracers)
+        if event != 'call' or index.plain:
+            return True
+        return self._traces_frame(self._code_tracers(index, fi, None), fi)
+
+    def _trace_tree(self, nodes, frame, event, arg, fi, counts):
+        """Give an event to the tracers of a tree. With ``counts``, the
+        counters for ``stats()``, what each tracer does is counted there.
+        """
+
+        for tracer, taken, subtree in nodes:
+            if taken:
+                if counts is not None:
+                    start = _clock_ns()
+                failed = False
+                try:
+                    dispatch = getattr(tracer, 'dispatch', None)
+                    if dispatch is None:
+                        tracer(frame, event, arg)
+                        handled = True
+                    else:
+                        handled = dispatch(fi, event, arg)
+                except BaseException:
+                    failed = True
+                    _report_tracer_error(tracer)
+                if counts is not None:
+                    counters = counts.get(tracer)
+                    if counters is None:
+                        counters = counts[tracer] = [0, 0, 0, 0]
+                    counters[2 if failed else 0 if handled else 1] += 1
+                    counters[3] += _clock_ns() - start
+            if subtree and tracer.incall > 0:
+                self._trace_tree(subtree, frame, event, arg, fi, counts)
+
+    def _traces_frame(self, nodes, fi):
+        """Whether any tracer wants the events within a frame."""
+
+        for tracer, taken, subtree in nodes:
+            if taken:
+                try:
+                    if tracer.traces_frame(fi):
+                        return True
+                except BaseException:
+                    _report_tracer_error(tracer)
+            # The parent's in-call status can't change within the frame
+            if subtree and tracer.incall > 0 and self._traces_frame(subtree, fi):
+                return True
+        return False
+
+    def _run_budget(self, stopped):
+        # Checked from a thread, as once every tracer is suspended no events
+        # arrive to check it from
+        while not stopped.wait(self.budget_interval):
+            self._check_budget(_clock_ns())
+
+    def _check_budget(self, now):
+        """Take a step to keep to the budget, or undo one, from the share of
+        the wall time the tracers took since the last check.
+        """
+
+        # One thread checks, while the others carry on
+        if not self._budget_lock.acquire(False):
+            return
+        try:
+            tracers = self.stats()['tracers']
+            spent = sum(t.time_ns for t in tracers)
+            cpu = _process_clock_ns()
+            elapsed = float(max(now - self._budget_start, 1))
+            share = (spent - self._budget_spent) / elapsed
+            # How busy the process was outside of the tracers
+            busy = max(cpu - self._budget_cpu - (spent - self._budget_spent), 0) / elapsed
+            if share > self.budget:
+                # The most expensive tracer, from its time since the last check
+                times = self._budget_times
+                costs = sorted((t.time_ns - times.get(t.tracer, 0), i)
+                               for i, t in enumerate(tracers) if t.tracer not in self._suspended)
+                if costs:
+                    self._budget_step(tracers[costs[-1][1]].tracer, share, busy)
+            elif share < self.budget / 2 and self._budget_steps:
+                # The share the tracers would take again without the step
+                step_share, step_busy = self._budget_steps[-1][3:]
+                if step_busy:
+                    step_share *= busy / step_busy
+                elif not busy:
+                    step_share = 0
+                if step_share < self.budget / 2:
+                    self._budget_undo(share)
+            self._budget_start = now
+            self._budget_spent = spent
+            self._budget_cpu = cpu
+            self._budget_times = dict((t.tracer, t.time_ns) for t in tracers)
+        finally:
+            self._budget_lock.release()
+
+    def _budget_step(self, tracer, share, busy=0):
+        taken = [step for t, step, saved, s, b in self._budget_steps if t is tracer]
+        events = getattr(tracer, 'events', ())
+        if events is None:
+            events = _default_events
+        # Returns are kept, for tracers which keep a stack or gate children
+        calls = _budget_events.intersection(events)
+        saved = None
+        if 'sample' not in taken and hasattr(tracer, 'watch'):
+            step = 'sample'
+            tracer.watch('sample:%d' % self.budget_sample)
+        elif 'calls' not in taken and 'call' in calls and calls != set(events):
+            step = 'calls'
+            saved = tracer.events
+            tracer.events = sorted(calls)
+        else:
+            step = 'suspend'
+            self._suspended.add(tracer)
+            _tracing_changed()
+        self._budget_steps.append((tracer, step, saved, share, busy))
+        _log.warning("Tracing took %.1f%% of the time, over its budget of %.1f%%: %s %r",
+                     share * 100, self.budget * 100, {
+                         'sample': 'sampling 1 in %d calls of' % self.budget_sample,
+                         'calls': 'tracing only call, return and exception events of',
+                         'suspend': 'suspending',
+                     }[step], tracer)
+
+    def _budget_undo(self, share=None):
+        tracer, step, saved = self._budget_steps.pop()[:3]
+        if step == 'sample':
+            tracer.unwatch('sample:%d' % self.budget_sample)
+        elif step == 'calls':
+            tracer.events = saved
+        else:
+            self._suspended.discard(tracer)
+            _tracing_changed()
+        if step != 'calls' and hasattr(tracer, 'reset'):
+            # The returns of the calls it saw may have been missed, or those
+            # of calls it didn't see may now come
+            tracer.reset()
+        if share is not None:
+            _log.warning("Tracing took %.1f%% of the time, under its budget of %.1f%%: "
+                         "restoring %r", share * 100, self.budget * 100, tracer)
+
+    def stats(self):
+        """A snapshot of the counters kept with ``stats=True``: a dict with
+        ``events``, the number of events received of each type, and
+        ``tracers``, a ``TracerStats`` for each tracer. A tracer's events
+        are ``dispatched`` if it handled them or ``rejected`` if its
+        ``watch`` rules turned them down. Events not among its ``events``,
+        or in functions its ``match:`` rules leave out, are not given to
+        it. ``errors`` counts the exceptions it raised, and ``time_ns`` is
+        the time spent in it.
+        """
+
+        events = collections.defaultdict(int)
+        tracers = collections.OrderedDict((tracer, [0, 0, 0, 0]) for tracer in self.tracers)
+        for thread_events, thread_tracers in list(self._all_stats):
+            for event, count in list(thread_events.items()):
+                events[event] += count
+            for tracer, counters in list(thread_tracers.items()):
+                totals = tracers.setdefault(tracer, [0, 0, 0, 0])
+                for i, count in enumerate(counters):
+                    totals[i] += count
+        return {
+            'events': dict(events),
+            'tracers': [TracerStats(tracer, *totals) for tracer, totals in tracers.items()],
+        }
+
+    def reset_stats(self):
+        """Set all the counters back to zero."""
+
+        for events, tracers in list(self._all_stats):
+            events.clear()
+            tracers.clear()
+
+    def _code_watched(self, fi):
+        """Whether any tracer could handle events for the frame's code."""
+
+        for tracer in self.tracers:
+            check_code = getattr(tracer, 'check_code', None)
+            if check_code is None or check_code(fi):
+                return True
+        return False
 
     def start(self):
         """Begin tracing with all the tracers registered."""
@@ -137,7 +1003,27 @@ class TracerManager(object):
                 tracer.watch("-match:tracerlib.TracerManager.__exit__")
                 tracer.watch("-match:tracerlib.TracerManager.stop")
 
-        _start_tracing()
+        try:
+            _start_tracing()
+        except Exception:
+            # Don't leave the manager active if its events can't be delivered
+            _active_managers.remove(self)
+            if not _active_managers:
+                _stop_tracing()
+            for tracer in self.tracers:
+                if hasattr(tracer, 'unwatch'):
+                    tracer.unwatch("-match:tracerlib.TracerManager.__exit__")
+                    tracer.unwatch("-match:tracerlib.TracerManager.stop")
+            raise
+        if self.budget is not None and self._budget_thread is None:
+            self._budget_start = _clock_ns()
+            tracers = self.stats()['tracers']
+            self._budget_spent = sum(t.time_ns for t in tracers)
+            self._budget_times = dict((t.tracer, t.time_ns) for t in tracers)
+            self._budget_cpu = _process_clock_ns()
+            stopped = self._budget_stopped = threading.Event()
+            self._budget_thread = _start_internal_thread(
+                lambda: self._run_budget(stopped), 'tracerlib-budget')
     __enter__ = start 
 
     def stop(self):
@@ -147,12 +1033,24 @@ class TracerManager(object):
         if not _active_managers:
             _stop_tracing()
 
+        if self._budget_thread is not None:
+            self._budget_stopped.set()
+            self._budget_thread.join()
+            self._budget_thread = None
+        while self._budget_steps:
+            self._budget_undo()
+
         # We don't need to trace our own exit
         for tracer in self.tracers:
             if hasattr(tracer, 'unwatch'):
                 tracer.unwatch("-match:tracerlib.TracerManager.__exit__")
                 tracer.unwatch("-match:tracerlib.TracerManager.stop")
 
+        for tracer in self.tracers:
+            finish = getattr(tracer, 'finish', None)
+            if finish is not None:
+                finish()
+
     def __exit__(self, type_, value, tb):
         self.stop()
 
@@ -163,24 +1061,188 @@ def print_call(frame, event, arg):
         print(fi.name, fi.args, fi.kwargs)
 
 
+_code_infos = {}
+_code_serials = itertools.count(1)
+# Weak references to the _CodeCache instances, by id
+_code_caches = {}
+
+
+class _CodeCache(dict):
+    """A dict of something decided for each code object, by its ``serial``,
+    whose entries are removed when their code objects are released. It
+    belongs to whatever made the decisions, so it goes away with it.
+    """
+
+    def __init__(self):
+        super(_CodeCache, self).__init__()
+        key = id(self)
+        _code_caches[key] = weakref.ref(self, lambda ref: _code_caches.pop(key, None))
+
+def _forget_code(key, serial):
+    _code_infos.pop(key, None)
+    for ref in list(_code_caches.values()):
+        cache = ref()
+        if cache is not None:
+            cache.pop(serial, None)
+
+class CodeInfo(object):
+    """The names of a code object, resolved once and shared by every frame
+    running that code. ``serial`` is a small integer identifying the code
+    object within the process.
+    """
+
+    __slots__ = ('serial', 'func_name', 'module', 'is_generator',
+                 'is_global', 'qual_name', '_ref')
+
+    def __init__(self, code):
+        self._ref = None
+        self.serial = next(_code_serials)
+        self.func_name = code.co_name
+        self.module = inspect.getmodulename(code.co_filename)
+        # Generators and coroutines suspend and resume
+        self.is_generator = bool(code.co_flags & _generator_flags)
+
+        try:
+            module = sys.modules[self.module]
+        except KeyError:
+            module = sys.modules['__main__']
+        func = getattr(module, '__dict__', {}).get(self.func_name)
+        self.is_global = getattr(func, '__code__', None) is code
+
+        qualname = getattr(code, 'co_qualname', None)
+        if qualname is not None:
+            self.qual_name = '%s.%s' % (self.module, qualname)
+        elif self.is_global:
+            self.qual_name = '%s.%s' % (self.module, self.func_name)
+        else:
+            class_name = _find_class_name(sys.modules.get(self.module), code.co_firstlineno)
+            self.qual_name = '%s.%s.%s' % (self.module, class_name, self.func_name)
+
+_generator_flags = 0
+for _name in ('CO_GENERATOR', 'CO_COROUTINE', 'CO_ITERABLE_COROUTINE', 'CO_ASYNC_GENERATOR'):
+    _generator_flags |= getattr(inspect, _name, 0)
+
+_yield_ops = frozenset(dis.opmap[name] for name in ('YIELD_VALUE', 'YIELD_FROM')
+                       if name in dis.opmap)
+# Before Python 3.11, a frame suspended in a ``yield from`` or ``await`` is
+# left at the instruction before its YIELD_FROM, to run it again
+_yield_from_op = dis.opmap.get('YIELD_FROM')
+# From Python 3.11, frames start and resume at a RESUME whose argument
+# tells which
+_resume_op = dis.opmap.get('RESUME')
+
+def _frame_op(frame):
+    """The opcode and argument of a frame's current instruction."""
+
+    code = frame.f_code.co_code
+    lasti = frame.f_lasti
+    if isinstance(code, str):
+        # Python 2, where only the opcode is needed
+        return ord(code[lasti]), 0
+    return code[lasti], code[lasti + 1]
+
+def _frame_resumed(frame):
+    """Whether a generator or coroutine frame is resuming at its ``call``
+    event, rather than starting.
+    """
+
+    if _resume_op is None:
+        return frame.f_lasti >= 0
+    op, oparg = _frame_op(frame)
+    return op != _resume_op or oparg & 3 != 0
+
+def _frame_at_yield(frame):
+    """Whether a generator or coroutine frame is stopped at a yield or await."""
+
+    if frame.f_lasti < 0:
+        return False
+    op, oparg = _frame_op(frame)
+    if op in _yield_ops or (op == _resume_op and oparg & 3 != 0):
+        return True
+    if _yield_from_op is not None and _resume_op is None:
+        code = frame.f_code.co_code
+        # Instructions are two bytes long from Python 3.6
+        return code[frame.f_lasti + 2:frame.f_lasti + 3] == bytes([_yield_from_op])
+    return False
+
+def _find_class_name(module, lineno):
+    """Walk backwards through the source of a module from ``lineno``, looking
+    for the previous class statement. Assume the line is "in" that class.
+    """
+
+    if module is None:
+        return '<unknown class>'
+    try:
+        source = inspect.getsourcelines(module)[0]
+    except (IOError, TypeError):
+        return '<unknown class>'
+    while 0 < lineno <= len(source):
+        if source[lineno - 1].startswith('class '):
+            return source[lineno - 1].split('class ', 1)[1].rstrip(':\n').split('(')[0]
+        lineno -= 1
+    return '<unknown class>'
+
+def code_info(code):
+    """Return the ``CodeInfo`` for a code object.
+
+    Results are cached for as long as the code object is alive, so modules
+    which are reloaded do not keep their old entries around.
+    """
+
+    key = id(code)
+    try:
+        return _code_infos[key]
+    except KeyError:
+        pass
+    info = CodeInfo(code)
+    try:
+        serial = info.serial
+        info._ref = weakref.ref(code, lambda ref: _forget_code(key, serial))
+    except TypeError:
+        return info
+    _code_infos[key] = info
+    return info
+
+
 class FrameInspector(object):
-    """Utility class to wrap a frame and introspect it easily."""
+    """Utility class to wrap a frame and introspect it easily. One is made
+    for every traced frame, so it has no ``__dict__``.
+    """
+
+    __slots__ = ('frame', '_arg_values', '_args', '_kwargs', '_code_info', '_samples',
+                 '_resumed', '_suspended', 'unwinding')
 
     def __init__(self, frame):
         self.frame = frame
         self._arg_values = None
+        self._args = None
+        self._kwargs = None
+        self._code_info = None
+        self._samples = None
+        self._resumed = None
+        self._suspended = None
+        # Set by the backends while an exception propagates in the frame
+        self.unwinding = False
     
     def all_arg_values(self):
+        """An ordered mapping of the arguments, with the names of ``*args``
+        and ``**kwargs`` parameters prefixed with their stars. Only read from
+        the frame the first time it is needed.
+        """
+
         if self._arg_values is None:
-            arginfo = inspect.getargvalues(self.frame)
-            L = arginfo.locals
+            code = self.frame.f_code
+            L = self.frame.f_locals
+            names = code.co_varnames
+            n = code.co_argcount + getattr(code, 'co_kwonlyargcount', 0)
             args = collections.OrderedDict()
-            for aname in arginfo.args:
+            for aname in names[:n]:
                 args[aname] = L[aname]
-            if arginfo.varargs:
-                args['*' + arginfo.varargs] = L[arginfo.varargs]
-            if arginfo.keywords:
-                args['**' + arginfo.keywords] = L[arginfo.keywords]
+            if code.co_flags & inspect.CO_VARARGS:
+                args['*' + names[n]] = L[names[n]]
+                n += 1
+            if code.co_flags & inspect.CO_VARKEYWORDS:
+                args['**' + names[n]] = L[names[n]]
             self._arg_values = args
         return self._arg_values
 
@@ -190,25 +1252,57 @@ class FrameInspector(object):
 
         return self.frame.f_code.co_name
 
+    @property
+    def samples(self):
+        """The decisions of sampling rules for this frame."""
+
+        if self._samples is None:
+            self._samples = {}
+        return self._samples
+
+    @property
+    def code_info(self):
+        """The cached ``CodeInfo`` for the function's code object."""
+
+        if self._code_info is None:
+            self._code_info = code_info(self.frame.f_code)
+        return self._code_info
+
+    @property
+    def resumed(self):
+        """At a ``call`` event, whether the frame is a generator or coroutine
+        resuming, rather than starting.
+        """
+
+        if self._resumed is None:
+            self._resumed = self.code_info.is_generator and _frame_resumed(self.frame)
+        return self._resumed
+
+    @property
+    def suspended(self):
+        """At a ``return`` event, whether the frame is a generator or
+        coroutine suspending at a yield or await, rather than returning.
+
+        ``sys.setprofile`` gives no exception events, so with that backend a
+        generator which is closed or thrown into is seen to suspend.
+        """
+
+        if self._suspended is None:
+            self._suspended = (self.code_info.is_generator and not self.unwinding
+                               and _frame_at_yield(self.frame))
+        return self._suspended
+
     @property
     def module(self):
         """The name of the module which defines the function."""
 
-        return inspect.getmodulename(self.frame.f_code.co_filename)
+        return self.code_info.module
 
     @property
     def is_global(self):
         """If the function is defined module-level."""
 
-        try:
-            module = sys.modules[self.module]
-        except KeyError:
-            module = sys.modules['__main__']
-
-        try:
-            return getattr(module, self.func_name).func_code == self.frame.f_code
-        except AttributeError:
-            return False
+        return self.code_info.is_global
 
     @property
     def qual_name(self):
@@ -216,54 +1310,367 @@ class FrameInspector(object):
         qualified name, which can be used to identify the function uniquely.
         """
 
-        if self.is_global:
-            return '%s.%s' % (self.module, self.func_name)
-        # Try to find a class the function was defined in
-        module = sys.modules.get(self.module)
-        lineno = self.frame.f_code.co_firstlineno
-        if module:
-            source = inspect.getsourcelines(module)[0]
-            class_name = None
-            def get_indent():
-                return len(source[lineno - 1]) - len(source[lineno - 1].lstrip(' \t'))
-            indent = get_indent()
-            # Walk backwards through the source from the current line, looking
-            # for the previous class statement. Assume we're "in" that class.
-            while class_name is None and lineno >= 0:
-                if source[lineno - 1].startswith('class '):
-                    class_name = source[lineno - 1].split('class ', 1)[1].rstrip(':\n').split('(')[0]
-                    break
-                lineno -= 1
-            else:
-                class_name = '<unknown class>'
-        else:
-            module = '<unknown module>'
-            class_name = '<unknown class>'
-
-        return '%s.%s.%s' % (self.module, class_name, self.func_name)
+        return self.code_info.qual_name
 
     @property
     def args(self):
         """The positional arguments passed to the function."""
 
-        all_args = self.all_arg_values()
-        args = []
-        for (k, v) in all_args.items():
-            if k.startswith('**'):
-                break
-            elif k.startswith('*'):
-                args.extend(v)
-            else:
-                args.append(v)
-        return tuple(args)
+        if self._args is None:
+            args = []
+            for (k, v) in self.all_arg_values().items():
+                if k.startswith('**'):
+                    break
+                elif k.startswith('*'):
+                    args.extend(v)
+                else:
+                    args.append(v)
+            self._args = tuple(args)
+        return self._args
 
     @property
     def kwargs(self):
         """The keyword arguments passed to the function."""
 
-        arginfo = inspect.getargvalues(self.frame)
-        L = arginfo.locals
-        return L.get(arginfo.keywords, {})
+        if self._kwargs is None:
+            self._kwargs = {}
+            for (k, v) in self.all_arg_values().items():
+                if k.startswith('**'):
+                    self._kwargs = v
+        return self._kwargs
+
+
+class WatchRule(object):
+    """A compiled watch rule.
+
+    Rules are parsed once, when they are given to a ``Tracer``, so that
+    checking an event only has to evaluate them. ``negate`` inverts the
+    outcome of the rule.
+    """
+
+    #: Static rules depend only on the code object being run, so their
+    #: outcome can be cached per code object.
+    static = True
+
+    def __init__(self, path, value, negate=False):
+        self.path = path
+        self.value = value
+        self.negate = negate
+
+    def matches(self, fi, event, arg):
+        """Return True if the event passes this rule, ignoring negation."""
+
+        return True
+
+
+class MatchRule(WatchRule):
+    """Matches a fully qualified function name exactly."""
+
+    def matches(self, fi, event, arg):
+        return fi.qual_name == self.value
+
+
+class PrefixRule(WatchRule):
+    """Matches any qualified name starting with a prefix, from ``path.*``."""
+
+    def matches(self, fi, event, arg):
+        return fi.qual_name.startswith(self.value)
+
+
+class LineRule(WatchRule):
+    """Matches line events on a given line number."""
+
+    static = False
+
+    def __init__(self, path, value, negate=False):
+        super(LineRule, self).__init__(path, int(value), negate)
+
+    def matches(self, fi, event, arg):
+        return event != 'line' or fi.frame.f_lineno == self.value
+
+
+_condition_codes = {}
+
+def _compile_condition(source):
+    # Shared by all the tracers watching the same condition
+    try:
+        return _condition_codes[source]
+    except KeyError:
+        code = _condition_codes[source] = compile(source, '<tracerlib condition>', 'eval')
+        return code
+
+
+class ConditionRule(WatchRule):
+    """Matches when a condition is true in the traced frame.
+
+    The condition is either a Python expression, evaluated in the frame's
+    globals and locals, or a callable taking ``(frame, event, arg)``. A
+    condition which raises an exception does not match, and the error is
+    counted in ``errors``, with the latest one kept in ``last_error``.
+    """
+
+    static = False
+
+    def __init__(self, path, value, negate=False):
+        super(ConditionRule, self).__init__(path, value, negate)
+        self.errors = 0
+        self.last_error = None
+        if callable(value):
+            self._func = value
+            self._code = None
+        else:
+            self._func = None
+            self._code = _compile_condition(value)
+
+    def matches(self, fi, event, arg):
+        frame = fi.frame
+        try:
+            if self._func is not None:
+                return bool(self._func(frame, event, arg))
+            return bool(eval(self._code, frame.f_globals, frame.f_locals))
+        except Exception as e:
+            self.errors += 1
+            self.last_error = e
+            return False
+
+
+class SampleRule(WatchRule):
+    """Matches only a sample of the calls to each function, from
+    ``sample:N`` to trace every Nth call, starting with the first, or
+    ``sample:0.1`` to trace a random fraction of them.
+
+    The decision is made once per frame, at its call, so all the events of
+    a sampled call are traced and none of the events of the others are. A
+    generator or coroutine keeps the decision made at its first call each
+    time it resumes, and its resumes are not counted as calls. The events
+    of a frame whose call it didn't see, which started before the rule was
+    added, are all traced.
+    """
+
+    static = False
+    per_frame = True
+    # How many suspended generators and coroutines to remember the decision
+    # of. Those forgotten are traced when they resume
+    max_frames = 1000
+
+    def __init__(self, path, value, negate=False):
+        if '.' in value:
+            value = float(value)
+            if not 0 < value <= 1:
+                raise ValueError("Sample fraction must be between 0 and 1: %r" % (path,))
+        else:
+            value = int(value)
+            if value < 1:
+                raise ValueError("Sample interval must be at least 1: %r" % (path,))
+        super(SampleRule, self).__init__(path, value, negate)
+        # The calls counted for each code object
+        self._counts = _CodeCache()
+        # The decisions for generator and coroutine frames, by frame id
+        self._frames = collections.OrderedDict()
+
+    def matches(self, fi, event, arg):
+        if event == 'return' and fi.code_info.is_generator and not fi.suspended:
+            self._frames.pop(id(fi.frame), None)
+        samples = fi.samples
+        try:
+            return samples[self]
+        except KeyError:
+            pass
+        if event != 'call':
+            # The frame's call wasn't seen
+            return True
+        if fi.resumed:
+            sampled = self._frames.get(id(fi.frame), True)
+        else:
+            if isinstance(self.value, float):
+                sampled = random.random() < self.value
+            else:
+                serial = fi.code_info.serial
+                count = self._counts.get(serial, 0)
+                self._counts[serial] = count + 1
+                sampled = count % self.value == 0
+            if fi.code_info.is_generator:
+                frames = self._frames
+                frames[id(fi.frame)] = sampled
+                if len(frames) > self.max_frames:
+                    try:
+                        frames.popitem(last=False)
+                    except KeyError:
+                        # Emptied by another thread
+                        pass
+        samples[self] = sampled
+        return sampled
+
+
+# The events delivered to a frame's local trace function
+_local_events = frozenset(['line', 'return', 'exception'])
+
+_rule_types = {
+    'match': MatchRule,
+    'line': LineRule,
+    'true': ConditionRule,
+    'sample': SampleRule,
+}
+
+def compile_rule(path):
+    """Compile a watch path, like ``-match:package.module.*``, to a rule.
+
+    A callable is compiled to a condition, called as ``(frame, event, arg)``.
+    """
+
+    if callable(path):
+        return ConditionRule(path, path)
+    negate = path[0] == '-'
+    watch = path[1 if negate else 0:]
+    try:
+        rule_type, watch = watch.split(':', 1)
+    except ValueError:
+        rule_type = 'match'
+    if rule_type == 'match' and watch.endswith('.*'):
+        return PrefixRule(path, watch[:-2], negate)
+    return _rule_types.get(rule_type, WatchRule)(path, watch, negate)
+
+
+class _TrieNode(object):
+
+    __slots__ = ('children', 'exact', 'prefixes')
+
+    def __init__(self):
+        self.children = {}
+        # (tracer, negate) of the match rules ending at this node
+        self.exact = []
+        # (tracer, negate) of the prefix rules ending at this node, by the
+        # start of the next segment they match, often all of it
+        self.prefixes = {}
+
+
+class _WatchIndex(object):
+    """An index of the ``match:`` rules of many tracers, to find the tracers
+    whose static rules pass for a qualified name in one walk of its
+    segments, however many rules there are.
+
+    The rules are kept in a trie over the dotted segments of the names they
+    match. A prefix rule ends with the start of the segment its prefix ends
+    in, so it matches any name starting with it, just as ``PrefixRule``
+    does. Tracers with other static rules, and plain trace functions, are
+    not indexed and always pass.
+    """
+
+    def __init__(self, tracers):
+        self._root = _TrieNode()
+        # The number of positive rules of each indexed tracer, all of which
+        # must match a name for the tracer to pass
+        self._positives = {}
+        self._unindexed = set()
+        for tracer in tracers:
+            rules = getattr(tracer, '_static_rules', None)
+            if rules is None or [r for r in rules if type(r) not in (MatchRule, PrefixRule)]:
+                self._unindexed.add(tracer)
+                continue
+            self._positives[tracer] = 0
+            for rule in rules:
+                self._add(tracer, rule)
+
+    def _add(self, tracer, rule):
+        segments = rule.value.split('.')
+        node = self._root
+        for segment in segments[:-1]:
+            node = node.children.setdefault(segment, _TrieNode())
+        if isinstance(rule, PrefixRule):
+            node.prefixes.setdefault(segments[-1], []).append((tracer, rule.negate))
+        else:
+            node = node.children.setdefault(segments[-1], _TrieNode())
+            node.exact.append((tracer, rule.negate))
+        if not rule.negate:
+            self._positives[tracer] += 1
+
+    def tracers(self, qual_name):
+        """The set of the tracers whose static rules pass for a name."""
+
+        matched = []
+        node = self._root
+        for segment in qual_name.split('.'):
+            if node.prefixes:
+                for i in range(len(segment) + 1):
+                    entries = node.prefixes.get(segment[:i])
+                    if entries:
+                        matched.extend(entries)
+            node = node.children.get(segment)
+            if node is None:
+                break
+        else:
+            matched.extend(node.exact)
+
+        counts = dict.fromkeys(self._positives, 0)
+        for tracer, negate in matched:
+            if negate:
+                counts[tracer] = None
+            elif counts[tracer] is not None:
+                counts[tracer] += 1
+        passed = set(self._unindexed)
+        for tracer, positives in self._positives.items():
+            if counts[tracer] == positives:
+                passed.add(tracer)
+        return passed
+
+
+def _current_task():
+    """The asyncio task running in the current thread, if any."""
+
+    asyncio = sys.modules.get('asyncio')
+    if asyncio is None or asyncio._get_running_loop() is None:
+        return None
+    try:
+        return asyncio.current_task()
+    except AttributeError:
+        # Before Python 3.7
+        return asyncio.Task.current_task()
+
+
+class _StackState(object):
+    """A tracer's state for one logical stack, that of a thread or of an
+    asyncio task running in it.
+    """
+
+    __slots__ = ('task_name', 'incall', 'depth', 'call_stack', 'suspended')
+
+    def __init__(self, task_name=None):
+        self.task_name = task_name
+        self.incall = 0
+        # The depth of the stack, for tracers which keep no call_stack
+        self.depth = 0
+        self.call_stack = []
+        # Frame records of suspended generators and coroutines, by frame id
+        self.suspended = collections.OrderedDict()
+
+
+class _ThreadState(threading.local):
+    """A tracer's state for each thread, as every thread has its own stack,
+    and so has every asyncio task it runs.
+    """
+
+    def __init__(self):
+        self.stack = _StackState()
+        self.tasks = weakref.WeakKeyDictionary()
+
+    def current(self):
+        """The state of the current task, or else of the thread."""
+
+        task = _current_task()
+        if task is None:
+            return self.stack
+        try:
+            return self.tasks[task]
+        except KeyError:
+            get_name = getattr(task, 'get_name', None)
+            name = get_name() if get_name is not None else 'Task-%x' % id(task)
+            state = self.tasks[task] = _StackState(name)
+            return state
+
+
+def _method_func(method):
+    # Unbound methods on Python 2, plain functions on Python 3
+    return getattr(method, '__func__', method)
 
 
 class Tracer(object):
@@ -284,115 +1691,231 @@ class Tracer(object):
     - c_return
     - c_exception
 
+    The ``c_*`` events are only delivered to tracers which list them.
+
     ``watch`` is a fully qualified name. If given, only functions which match
     will be traced. If ``watch`` is a path to a module, any function or
     method in the module will be traced. If it is a path to a class, only
     methods defined in that class will be traced.
 
+    ``sample`` traces only a sample of the calls to each function, either
+    every Nth call when it is an integer, or a random fraction of the calls
+    when it is a float. It is the same as watching ``sample:N``.
+
     Rather than passing a function to ``Tracer``, you may subclass it and
     define one or more of the ``trace_*()`` methods, which are invoked
     with event-specific arguments.
     """
 
-    def __init__(self, func=None, events=None, watch=None, parent=None):
-        self.events = events
+    # Subclasses set this false to get empty arguments in trace_call(),
+    # sparing reading them from every frame
+    call_args = True
+
+    def __init__(self, func=None, events=None, watch=None, parent=None, sample=None):
+        # A new tracer is not active yet, so tracing needn't be refreshed
+        self._events = events
+        self._event_set = _default_events if events is None else frozenset(events)
         self._trace = func
-        self._watch = []
+        self._watch = list(watch or ())
+        if sample is not None:
+            self._watch.append('sample:%s' % (sample,))
+        self._rules = [compile_rule(path) for path in self._watch]
         self.parent = parent
-        self.incall = 0
-        if watch is not None:
-            self._watch.extend(watch)
+        self._thread_state = _ThreadState()
+        self._overrides_trace_call = (
+            _method_func(type(self).trace_call) is not _method_func(Tracer.trace_call))
+        self._compile_rules()
+
+    def reset(self):
+        """Forget the calls in progress, in every thread and task, as after
+        missing some of their events.
+        """
+        self._thread_state = _ThreadState()
+
+    @property
+    def incall(self):
+        """How many calls this tracer is inside, in the current thread or
+        asyncio task.
+        """
+        return self._thread_state.current().incall
+
+    @incall.setter
+    def incall(self, value):
+        self._thread_state.current().incall = value
 
     def watch(self, path):
         """Add an additional watch path to match when tracing.
         
         package.module.functionname
         not:XXX
+
+        ``path`` can also be a callable taking ``(frame, event, arg)``, which
+        must return true for the event to be traced.
         """
 
+        rule = compile_rule(path)
         self._watch.append(path)
+        self._rules.append(rule)
+        self._rules_changed()
 
     def unwatch(self, path):
-        self._watch.remove(path)
+        i = self._watch.index(path)
+        del self._watch[i]
+        rule = self._rules.pop(i)
+        # Code must pass every static rule, so only removing one can widen
+        # the code watched
+        self._rules_changed(getattr(rule, 'static', False))
+
+    @property
+    def events(self):
+        return self._events
+
+    @events.setter
+    def events(self, events):
+        self._events = events
+        self._event_set = _default_events if events is None else frozenset(events)
+        _tracing_changed()
+
+    def _rules_changed(self, widened=False):
+        self._compile_rules()
+        # The rules of a tracer no active manager has, like those a manager
+        # stopping takes back, watch nothing
+        _tracing_changed(widened and any(
+            t is self for tm in _active_managers for t in tm.tracers))
+
+    def _compile_rules(self):
+        self._static_rules = [r for r in self._rules if r.static]
+        self._dynamic_rules = [r for r in self._rules if not r.static]
+        self._frame_rules = [r for r in self._rules if getattr(r, 'per_frame', False)]
+        # The decision of the static rules for each code object, made again
+        # under new rules when next needed
+        self._code_decisions = _CodeCache()
+
+    def traces_frame(self, fi):
+        """Whether this tracer could handle any events in a frame after its
+        ``call`` event. Only checks the ``events``, the static rules and the
+        sampling decision for the frame, as the parent's in-call status may
+        change while the frame runs.
+
+        Frames whose C function events a tracer samples are always kept, so
+        those events are given the decision made at the frame's call.
+        """
+
+        if not _local_events.intersection(self._event_set):
+            if not (self._frame_rules and _c_events.intersection(self._event_set)):
+                return False
+            return self.check_code(fi)
+        if not self.check_code(fi):
+            return False
+        for rule in self._frame_rules:
+            if rule.matches(fi, 'call', None) is rule.negate:
+                return False
+        return True
+
+    @property
+    def condition_errors(self):
+        """The number of times evaluating a condition raised an exception."""
+
+        return sum(getattr(rule, 'errors', 0) for rule in self._rules)
+
+    def check_code(self, fi):
+        """Check the static rules against the code object of a frame.
+
+        The decision is cached by the code's ``serial``, so this is a single
+        lookup after the first time a function is seen.
+        """
+
+        decisions = self._code_decisions
+        serial = fi.code_info.serial
+        try:
+            return decisions[serial]
+        except KeyError:
+            pass
+        for rule in self._static_rules:
+            if rule.matches(fi, None, None) is rule.negate:
+                decision = False
+                break
+        else:
+            decision = True
+        decisions[serial] = decision
+        return decision
 
     def check_event(self, frame, event, arg):
-        lineno = frame.f_lineno
-        successes = []
         self.frame_insp = fi = FrameInspector(frame)
-        func_name = fi.func_name
+        return self._check(fi, event, arg)
 
+    def _check(self, fi, event, arg):
         # If we have a parent, only proceed if the parent is in-call
         if self.parent is not None:
-            if not self.parent.incall:
+            if self.parent.incall <= 0:
                 return False
 
-        if self.events is None or event in self.events:
-            arginfo = fi.all_arg_values()
-
-            qn_parts = fi.qual_name.split('.')
-            for watch in self._watch:
-                orig_watch = watch
-                failed = False
-                negate = watch[0] == '-'
-                watch = watch[1 if negate else 0:]
-                try:
-                    rule_type, watch = watch.split(':', 1)
-                except ValueError:
-                    rule_type = 'match'
-                if rule_type == 'match':
-                    if watch.endswith('.*'):
-                        failed = not fi.qual_name.startswith(watch[:-2])
-                    elif watch != fi.qual_name:
-                        failed = True
-                elif rule_type == 'line' and event == 'line':
-                    failed = lineno != int(watch)
-                elif rule_type == 'true':
-                    try:
-                        #print('EVAL', repr(watch), 'IN', frame.f_locals)
-                        failed = not eval(watch, frame.f_globals, frame.f_locals)
-                    except Exception, e:
-                        #print('TRACERLIB CONDITION ERROR:', e.__class__.__name__, e)
-                        failed = True
+        if event not in self._event_set:
+            return False
 
-                if negate:
-                    failed = not failed
+        if not self.check_code(fi):
+            return False
+        for rule in self._dynamic_rules:
+            if rule.matches(fi, event, arg) is rule.negate:
+                return False
+        return True
 
-                #if fi.qual_name.startswith('testmod'):
-                #    print(rule_type, ('-' if negate else '+') + watch, fi.qual_name, 'failed' if failed else 'passed')
+    def __call__(self, frame, event, arg):
+        self.dispatch(FrameInspector(frame), event, arg)
+        return self
 
-                if not failed:
-                    successes.append(orig_watch)
+    def dispatch(self, fi, event, arg):
+        """Handle an event for the frame wrapped by ``fi``, if it passes the
+        ``events`` and ``watch`` rules. Returns whether it was handled.
 
-        return len(successes) == len(self._watch)
+        Arguments are only read from the frame for the handlers which are
+        given them.
+        """
 
-    def __call__(self, frame, event, arg):
-        if self.check_event(frame, event, arg):
-            fi = self.frame_insp
-            func_name = fi.func_name
-            lineno = frame.f_lineno
-
-            # Track incall status
-            if event == 'call':
-                self.incall += 1
-            elif event == 'exception':
-                self.incall -= 1
-            elif event == 'return':
-                self.incall -= 1
-
-            # Call registered trace function
-            if self._trace is not None:
-                self._trace(func_name, args=fi.args, kwargs=fi.kwargs, lineno=lineno)
-            elif event == 'exception':
-                self.trace_exception(func_name, fi.args, fi.kwargs, arg)
-            elif event == 'line':
-                self.trace_line(func_name, lineno)
-            elif event == 'return':
-                self.trace_return(func_name, arg)
-            elif event == 'call':
-                self.trace_call(func_name, fi, fi.args, fi.kwargs)
+        self.frame_insp = fi
+        if not self._check(fi, event, arg):
+            return False
+        func_name = fi.func_name
+        lineno = fi.frame.f_lineno
+
+        # Track incall status
+        if event == 'call':
+            self._thread_state.current().incall += 1
+        elif event == 'return':
+            state = self._thread_state.current()
+            # Unless its call was forgotten by reset()
+            if state.incall > 0:
+                state.incall -= 1
+
+        # Call registered trace function
+        if self._trace is not None:
+            self._trace(func_name, args=fi.args, kwargs=fi.kwargs, lineno=lineno)
+        elif event == 'exception':
+            exctype, value, tb = arg
+            self.trace_exception(func_name, exctype, value, tb)
+        elif event == 'line':
+            self.trace_line(func_name, lineno)
+        elif event == 'return':
+            if fi.suspended:
+                self.trace_suspend(func_name, arg)
             else:
-                getattr(self, 'trace_' + event)(func_name, fi.args, fi.kwargs)
-        return self
+                self.trace_return(func_name, arg)
+        elif event == 'call':
+            if fi.resumed:
+                self.trace_resume(func_name, fi)
+            # Don't read the arguments just to pass them to the no-op default
+            elif self._overrides_trace_call:
+                if self.call_args:
+                    self.trace_call(func_name, fi, fi.args, fi.kwargs)
+                else:
+                    self.trace_call(func_name, fi, (), {})
+        elif event == 'c_call':
+            self.trace_c_call(func_name, arg)
+        elif event == 'c_return':
+            self.trace_c_return(func_name)
+        elif event == 'c_exception':
+            self.trace_c_exception(func_name)
+        return True
 
     def trace_call(self, func_name, inspector, args, kwargs):
         """Handle a call event. Happens at the start of the called function."""
@@ -403,54 +1926,607 @@ class Tracer(object):
     def trace_return(self, func_name, return_value):
         """Handle a return event. Happens at the end of the returning function."""
 
+    def finish(self):
+        """Called when a ``TracerManager`` running this tracer stops."""
+
+    def trace_resume(self, func_name, inspector):
+        """Handle a generator or coroutine resuming, which is a call event.
+        Calls ``trace_call()`` unless overridden.
+        """
+
+        if self._overrides_trace_call:
+            self.trace_call(func_name, inspector, inspector.args, inspector.kwargs)
+
+    def trace_suspend(self, func_name, value):
+        """Handle a generator or coroutine suspending at a yield or await,
+        which is a return event. Calls ``trace_return()`` unless overridden.
+        """
+
+        self.trace_return(func_name, value)
+
     def trace_exception(self, func_name, exctype, value, tb):
         """Handle an exception event."""
 
     def trace_c_call(self, func_name, c_func):
-        pass
+        """Handle a call to a C function from the function ``func_name``."""
 
     def trace_c_return(self, func_name):
-        pass
+        """Handle a return from a C function to the function ``func_name``."""
 
     def trace_c_exception(self, func_name):
+        """Handle a C function called from ``func_name`` raising an exception."""
+
+
+class Sink(object):
+    """Somewhere for tracers to write their output to, one line at a time."""
+
+    def write(self, line):
+        """Write a single line, without its line ending."""
+
+        raise NotImplementedError
+
+    def write_lines(self, lines):
+        """Write a batch of lines."""
+
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        """Make sure everything written so far has been output."""
+
+    def close(self):
+        """Flush the sink. Nothing may be written to it afterwards."""
+
+        self.flush()
+
+
+class NullSink(Sink):
+    """Discards everything written to it."""
+
+    def write(self, line):
+        pass
+
+    def write_lines(self, lines):
         pass
 
 
-class StackFrameTracer(Tracer):
+class StreamSink(Sink):
+    """Writes lines to a file, or to ``sys.stdout`` if ``out`` is None.
+
+    The file is flushed, but not closed, by ``close()``.
+    """
+
+    def __init__(self, out=None):
+        self.out = out
+
+    def write(self, line):
+        print(line, file=self.out)
+
+    def write_lines(self, lines):
+        if lines:
+            out = self.out if self.out is not None else sys.stdout
+            out.write('\n'.join(lines) + '\n')
+
+    def flush(self):
+        out = self.out if self.out is not None else sys.stdout
+        out.flush()
+
+
+class ProcessFileSink(Sink):
+    """Writes the lines of each process to its own file in ``directory``,
+    named from ``prefix``, the process id and its start time in
+    milliseconds, so many processes can be traced at once without sharing a
+    file. A child process opens a new file when it forks.
+
+    Each file starts with a header describing the process and every line is
+    stamped with the wall clock time it was written, for
+    ``merge_process_traces()`` to put the lines of all the processes in
+    order. A file is flushed by the first line written once
+    ``flush_interval`` seconds have passed since it was last flushed, so
+    the lines before a quiet spell can wait in the buffer until the next
+    line, ``flush()`` or the process exit.
+    """
+
+    def __init__(self, directory='.', prefix='tracerlib', flush_interval=1.0):
+        self.directory = directory
+        self.prefix = prefix
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._mp_registered = False
+        self._open()
+        _fork_handlers.add(self)
+        atexit.register(self.close)
+
+    def _open(self):
+        self.pid = os.getpid()
+        start = _wall_clock_ns()
+        self.path = os.path.join(self.directory, '%s-%d-%d.trace' % (
+            self.prefix, self.pid, start // 1000000))
+        # Without os.register_at_fork, no parent's lines may be left in the
+        # buffer to be written again by a child
+        buffering = -1 if hasattr(os, 'register_at_fork') else 1
+        self.out = open(self.path, 'w', buffering)
+        self.out.write('# %s\n' % json.dumps({
+            'pid': self.pid,
+            'ppid': getattr(os, 'getppid', lambda: None)(),
+            'start': start,
+            'argv': getattr(sys, 'argv', []),
+        }, sort_keys=True))
+        self._flushed = start
+
+    def write(self, line):
+        with self._lock:
+            if self.out is None:
+                return
+            if self.pid != os.getpid():
+                self._after_fork()
+            now = _wall_clock_ns()
+            self.out.write('%d %s\n' % (now, line))
+            if now - self._flushed > self.flush_interval * 1e9:
+                self._flushed = now
+                self.out.flush()
+
+    def flush(self):
+        with self._lock:
+            if self.out is not None:
+                self.out.flush()
+
+    def close(self):
+        with self._lock:
+            if self.out is not None:
+                self.out.close()
+                self.out = None
+
+    def _before_fork(self):
+        mp_util = sys.modules.get('multiprocessing.util')
+        if mp_util is not None and not self._mp_registered:
+            # multiprocessing's children leave with os._exit(), skipping
+            # atexit, after dropping the finalizers they inherit
+            self._mp_registered = True
+            mp_util.register_after_fork(self, ProcessFileSink._register_finalizer)
+        self.flush()
+
+    def _register_finalizer(self):
+        sys.modules['multiprocessing.util'].Finalize(self, self.close, exitpriority=0)
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
+        if self.out is not None:
+            self.out.close()
+            self._open()
+
+
+def read_process_trace(path):
+    """Read a file written by ``ProcessFileSink``, returning its header and
+    an iterator of ``(timestamp, line)`` tuples.
+    """
+
+    f = open(path)
+    header = f.readline()
+    if not header.startswith('# '):
+        f.close()
+        raise ValueError("Not a tracerlib process trace: %s" % (path,))
+    header = json.loads(header[2:])
+
+    def lines():
+        with f:
+            for line in f:
+                timestamp, line = line.rstrip('\n').split(' ', 1)
+                yield int(timestamp), line
+    return header, lines()
+
+def merge_process_traces(paths, out=None):
+    """Write the lines of several process traces in time order, each after
+    the id of the process which wrote it.
+    """
+
+    def stamped(path):
+        header, lines = read_process_trace(path)
+        for timestamp, line in lines:
+            yield timestamp, header['pid'], line
+
+    for timestamp, pid, line in heapq.merge(*[stamped(path) for path in paths]):
+        print('%d %s' % (pid, line), file=out)
+
+def summarize_process_traces(paths, out=None):
+    """Write a line for each process trace: the process id, its parent's id,
+    the number of lines, the seconds between the first and the last, and the
+    command line.
+    """
+
+    print('pid\tppid\tlines\tseconds\tcommand', file=out)
+    for path in paths:
+        header, lines = read_process_trace(path)
+        count = 0
+        first = last = header['start']
+        for timestamp, line in lines:
+            if not count:
+                first = timestamp
+            last = timestamp
+            count += 1
+        print('%s\t%s\t%d\t%.3f\t%s' % (header['pid'], header['ppid'], count,
+                                          (last - first) / 1e9, ' '.join(header['argv'])),
+              file=out)
+
+
+class BufferedSink(Sink):
+    """Queues lines and writes them to another ``sink`` from a background
+    thread, in batches, so traced threads don't wait on I/O.
+
+    At most ``maxsize`` lines are queued. When the queue is full, ``policy``
+    decides what happens to a new line:
+
+    - ``'block'`` waits for the writer thread to catch up
+    - ``'drop-oldest'`` drops the oldest queued line
+    - ``'drop-newest'`` drops the new line
+
+    Dropped lines are counted in ``dropped``. Queued lines are written at
+    least every ``interval`` seconds, or as soon as ``batch_size`` of them
+    are waiting.
+    """
+
+    BLOCK = 'block'
+    DROP_OLDEST = 'drop-oldest'
+    DROP_NEWEST = 'drop-newest'
+
+    def __init__(self, sink, maxsize=10000, policy=BLOCK, batch_size=1000, interval=0.1):
+        if policy not in (self.BLOCK, self.DROP_OLDEST, self.DROP_NEWEST):
+            raise ValueError("Unknown policy %r" % (policy,))
+        self.sink = sink
+        self.maxsize = maxsize
+        self.policy = policy
+        self.batch_size = batch_size
+        self.interval = interval
+        self.dropped = 0
+        self.written = 0
+        self._queue = collections.deque()
+        self._cond = threading.Condition()
+        self._writing = False
+        self._closed = False
+        self._thread = _start_internal_thread(self._run, 'tracerlib-sink')
+        _fork_handlers.add(self)
+        atexit.register(self.close)
+
+    def write(self, line):
+        with self._cond:
+            queue = self._queue
+            if len(queue) >= self.maxsize:
+                if self.policy == self.DROP_NEWEST:
+                    self.dropped += 1
+                    return
+                elif self.policy == self.DROP_OLDEST:
+                    queue.popleft()
+                    self.dropped += 1
+                else:
+                    while len(queue) >= self.maxsize and not self._closed:
+                        self._cond.wait()
+            queue.append(line)
+            if len(queue) == self.batch_size:
+                self._cond.notify_all()
+
+    def flush(self):
+        with self._cond:
+            self._cond.notify_all()
+            while (self._queue or self._writing) and self._thread.is_alive():
+                self._cond.wait(self.interval)
+        self.sink.flush()
+
+    def close(self):
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join()
+        self.sink.close()
+
+    def _before_fork(self):
+        pass
+
+    def _after_fork(self):
+        # The queued lines are the parent's to write, and the writer thread
+        # is gone, maybe holding the lock
+        self._queue = collections.deque()
+        self._cond = threading.Condition()
+        self._writing = False
+        if not self._closed:
+            self._thread = _start_internal_thread(self._run, 'tracerlib-sink')
+
+    def _run(self):
+        cond = self._cond
+        while True:
+            with cond:
+                while not self._queue and not self._closed:
+                    cond.wait(self.interval)
+                if not self._queue:
+                    cond.notify_all()
+                    return
+                batch = list(self._queue)
+                self._queue.clear()
+                self._writing = True
+                cond.notify_all()
+            try:
+                self.sink.write_lines(batch)
+                self.sink.flush()
+            except Exception:
+                traceback.print_exc()
+            with cond:
+                self._writing = False
+                self.written += len(batch)
+                cond.notify_all()
+
+
+class FrameRecord(object):
+    """Records one frame on a ``StackTracer``'s stack. It keeps only the
+    names and id of the frame and the times, line and types seen in it, not
+    the frame, its arguments or its return value, so a deep stack or many
+    suspended generators cost little memory and keep nothing alive.
+
+    ``wall_ns`` is the time from the call to the return, and ``cpu_ns`` the
+    CPU time of the thread while the frame was running, so for a coroutine
+    the time it spent suspended counts only towards ``wall_ns``.
+
+    ``inclusive_ns`` is the time the frame was running, including the frames
+    it called, and ``exclusive_ns`` the part of it spent in the frame itself.
+    """
+
+    __slots__ = ('func_name', 'qual_name', 'serial', 'frame_id', 'lineno', 'return_type',
+                 'exc_type', 'suspensions', 'wall_ns', 'cpu_ns', 'inclusive_ns', 'child_ns',
+                 'stack_key', '_start_ns', '_run_start_ns', '_cpu_start_ns')
+
     def __init__(self, func_name, inspector, args, kwargs):
-        super(StackFrameTracer, self).__init__()
+        info = inspector.code_info
         self.func_name = func_name
-        self.inspector = inspector
-        self.args = args
-        self.kwargs = kwargs
+        self.qual_name = info.qual_name
+        self.serial = info.serial
+        self.frame_id = id(inspector.frame)
         self.lineno = None
+        self.return_type = None
+        self.exc_type = None
+        self.suspensions = 0
+        self.wall_ns = None
+        self.cpu_ns = 0
+        self.inclusive_ns = 0
+        # The inclusive time of the frames called from this one
+        self.child_ns = 0
+        # The serials of the frames from the outermost, see CallGraphTracer
+        self.stack_key = None
+        self._start_ns = self._run_start_ns = _clock_ns()
+        self._cpu_start_ns = _cpu_clock_ns()
+
+    @property
+    def exclusive_ns(self):
+        return self.inclusive_ns - self.child_ns
 
     def trace_line(self, func_name, lineno):
         self.lineno = lineno
 
+    def trace_suspend(self, func_name, value):
+        self.suspensions += 1
+        self.inclusive_ns += _clock_ns() - self._run_start_ns
+        self.cpu_ns += _cpu_clock_ns() - self._cpu_start_ns
+
+    def trace_resume(self, func_name, inspector):
+        self._run_start_ns = _clock_ns()
+        self._cpu_start_ns = _cpu_clock_ns()
+
     def trace_return(self, func_name, return_value):
+        now = _clock_ns()
+        self.inclusive_ns += now - self._run_start_ns
+        self.cpu_ns += _cpu_clock_ns() - self._cpu_start_ns
+        self.wall_ns = now - self._start_ns
+        self.return_type = type(return_value)
+
+    def trace_exception(self, func_name, exctype, value, tb):
+        self.exc_type = exctype
+
+
+class StackFrameTracer(FrameRecord):
+    """A ``FrameRecord`` which also keeps the ``FrameInspector``, the
+    arguments, and the ``return_value`` or ``exc_info`` of its frame. Use it
+    as the ``frame_tracer`` of a ``StackTracer``, or give that
+    ``retain_frames=True``, to look at them from within the stack.
+    """
+
+    __slots__ = ('inspector', 'args', 'kwargs', 'return_value', 'exc_info')
+
+    def __init__(self, func_name, inspector, args, kwargs):
+        super(StackFrameTracer, self).__init__(func_name, inspector, args, kwargs)
+        self.inspector = inspector
+        self.args = args
+        self.kwargs = kwargs
+        self.return_value = None
+        self.exc_info = None
+
+    def trace_resume(self, func_name, inspector):
+        super(StackFrameTracer, self).trace_resume(func_name, inspector)
+        self.inspector = inspector
+
+    def trace_return(self, func_name, return_value):
+        super(StackFrameTracer, self).trace_return(func_name, return_value)
         self.return_value = return_value
 
     def trace_exception(self, func_name, exctype, value, tb):
+        super(StackFrameTracer, self).trace_exception(func_name, exctype, value, tb)
         self.exc_info = (exctype, value, tb)
 
 
+class FunctionTiming(object):
+    """The times of all the finished calls to one function, in nanoseconds.
+    ``total_ns`` is inclusive of the functions it called, so recursive calls
+    are counted more than once, and ``self_ns`` is exclusive of them.
+    """
+
+    __slots__ = ('qual_name', 'count', 'total_ns', 'self_ns', 'min_ns', 'max_ns')
+
+    def __init__(self, qual_name):
+        self.qual_name = qual_name
+        self.count = 0
+        self.total_ns = 0
+        self.self_ns = 0
+        self.min_ns = None
+        self.max_ns = 0
+
+    def add(self, total_ns, self_ns):
+        """Add the times of one call."""
+
+        self.count += 1
+        self.total_ns += total_ns
+        self.self_ns += self_ns
+        if self.min_ns is None or total_ns < self.min_ns:
+            self.min_ns = total_ns
+        if total_ns > self.max_ns:
+            self.max_ns = total_ns
+
+    def merge(self, other):
+        """Add the times of all the calls of another ``FunctionTiming``."""
+
+        self.count += other.count
+        self.total_ns += other.total_ns
+        self.self_ns += other.self_ns
+        if other.min_ns is not None and (self.min_ns is None or other.min_ns < self.min_ns):
+            self.min_ns = other.min_ns
+        self.max_ns = max(self.max_ns, other.max_ns)
+
+
+# Types whose instances are immutable, and equal only to those with the
+# same repr, so their reprs can be cached by value. Not floats, as
+# 0.0 == -0.0 and NaN isn't equal to itself
+_cached_repr_types = frozenset(type(v) for v in (0, True, None, '', b'', u'', 2 ** 64))
+
+# The containers reprlib limits, for their subclasses, which it only knows by
+# type name
+_bounded_repr_bases = ((dict, 'repr_dict'), (list, 'repr_list'), (tuple, 'repr_tuple'),
+                       (set, 'repr_set'), (frozenset, 'repr_frozenset'))
+
+class BoundedRepr(reprlib.Repr):
+    """A ``reprlib.Repr`` which limits the length of the whole repr, as well
+    as the nesting depth, the items shown of each container and the length
+    of strings and numbers. Only the first line of a repr spanning several
+    is kept, and a repr which raises gives the default ``object`` one.
+
+    ``types`` maps types to functions returning the repr of their instances,
+    and of their subclasses', to use instead of the limited one, for example
+    to show only a few attributes of a large object. Reprs of integers and
+    of short strings are cached, as the same arguments are often passed
+    again.
+    """
+
+    def __init__(self, maxlength=200, maxlevel=3, maxitems=8, maxstring=60, types=None,
+                 cache_size=1024):
+        reprlib.Repr.__init__(self)
+        self.maxlength = maxlength
+        self.maxlevel = maxlevel
+        for name in ('maxtuple', 'maxlist', 'maxarray', 'maxdict', 'maxset', 'maxfrozenset',
+                     'maxdeque'):
+            setattr(self, name, maxitems)
+        self.maxstring = self.maxlong = maxstring
+        self.maxother = maxlength
+        self.types = dict(types or {})
+        self.cache_size = cache_size
+        self._cache = {}
+
+    def repr(self, obj):
+        cls = type(obj)
+        key = None
+        # Long strings and bytes are not kept alive, their reprs only read the ends
+        if cls in _cached_repr_types and (not isinstance(obj, (basestring, bytes)) or
+                                          len(obj) <= self.maxstring):
+            key = (cls, obj)
+            try:
+                return self._cache[key]
+            except KeyError:
+                pass
+
+        r = self.repr1(obj, self.maxlevel)
+        if '\n' in r:
+            r = r.split('\n', 1)[0] + ' ...'
+        if len(r) > self.maxlength:
+            r = r[:self.maxlength - 3] + '...'
+
+        if key is not None:
+            if len(self._cache) >= self.cache_size:
+                self._cache.clear()
+            self._cache[key] = r
+        return r
+
+    def repr1(self, x, level):
+        if self.types:
+            for cls in getattr(type(x), '__mro__', ()):
+                func = self.types.get(cls)
+                if func is not None:
+                    try:
+                        return func(x)
+                    except Exception:
+                        return object.__repr__(x)
+        try:
+            cls = type(x)
+            for base, name in _bounded_repr_bases:
+                if cls is not base and isinstance(x, base):
+                    r = getattr(self, name)(x, level)
+                    # Named tuples show as a call with their items
+                    return cls.__name__ + (r if base is tuple else '(%s)' % r)
+            return reprlib.Repr.repr1(self, x, level)
+        except Exception:
+            return object.__repr__(x)
+
+    def repr_bytes(self, x, level):
+        # Slices like a string, so only the ends are read
+        return self.repr_str(x, level)
+
+    def repr_bytearray(self, x, level):
+        return self.repr_str(x, level)
+
+
 class StackTracer(Tracer):
     """A specialized tracer which watches the entire callstack, and makes it
-    easy to respond and log within it. Can be given an ``out`` file to write
-    an outline of the entire call graph to.
+    easy to respond and log within it. Can be given an ``out`` file or
+    ``Sink`` to write an outline of the entire call graph to. Use a
+    ``BufferedSink`` to keep the writing out of the traced threads.
 
     If subclassing, you can define a ``frame_tracer`` class to a subclass of
-    ``StackFrameTracer`` which is create for each frame of the stack to trace
-    within it.
+    ``FrameRecord`` which is create for each frame of the stack to trace
+    within it. The default ``FrameRecord`` keeps no objects from the frame;
+    pass ``retain_frames=True`` to use ``StackFrameTracer``, which keeps the
+    frame, its arguments and its return value.
+
+    Each thread, and each asyncio task, has its own stack. A generator or
+    coroutine leaves the stack when it suspends and goes back on it when it
+    resumes, without being reported again, and the lines written from within
+    a task start with its name in brackets.
+
+    The time of every call is added up for its function in ``timings``. If
+    ``report_timings`` is true, a table of them is written when the
+    ``TracerManager`` stops.
+
+    Arguments and return values are written with ``arg_repr``, a
+    ``BoundedRepr`` which can be replaced to show more or less of them.
     """
 
-    frame_tracer = StackFrameTracer
+    frame_tracer = FrameRecord
+    arg_repr = BoundedRepr()
+    # How many suspended frames to remember for each stack. Generators which
+    # are abandoned never resume, and those forgotten are reported again
+    max_suspended = 1000
 
-    def __init__(self, out=None):
+    def __init__(self, out=None, report_timings=False, retain_frames=False):
         super(StackTracer, self).__init__()
-        self.call_stack = []
-        self.out = None
+        if retain_frames and self.frame_tracer is FrameRecord:
+            self.frame_tracer = StackFrameTracer
+        self.out = out
+        self.sink = out if isinstance(out, Sink) else StreamSink(out)
+        self.report_timings = report_timings
+        self._all_timings = []
+        self._thread_timings = _ThreadDicts(self._all_timings, 'timings')
+
+    @property
+    def call_stack(self):
+        """The stack of frame tracers for the current thread or asyncio task."""
+        return self._thread_state.current().call_stack
+
+    @call_stack.setter
+    def call_stack(self, value):
+        self._thread_state.current().call_stack = value
 
     @property
     def current(self):
@@ -464,55 +2540,520 @@ class StackTracer(Tracer):
 
     def report_call(self, func_name, args, kwargs):
         """Logs a call and its arguments."""
-        p = []
-        def a(s):
-            if isinstance(s, basestring):
-                if '\n' in s:
-                    s = s.split('\n', 1)[0] + ' ...'
-                p.append(s)
-            else:
-                try:
-                    r = repr(s)
-                except Exception:
-                    r = object.__repr__(s)
-                if '\n' in r:
-                    r = r.split('\n', 1)[0] + ' ...'
-                p.append(r)
-
-        a(' ' * (self.depth - 1))
-        a(func_name)
-        a('(')
-        for i, arg in enumerate(args):
-            if i > 0:
-                a(', ')
-            a(arg)
-        if args and kwargs:
-            a(', ')
-        for i, (k, v) in enumerate(kwargs.items()):
-            a(k)
-            a('=')
-            a(v)
-        a(')')
-
-        print(''.join(p), file=self.out)
+        r = self.arg_repr.repr
+        values = [r(v) for v in args]
+        values.extend('%s=%s' % (k, r(v)) for k, v in kwargs.items())
+        self.write('%s%s(%s)' % (' ' * (self.depth - 1), func_name, ', '.join(values)))
+
+    def write(self, line):
+        """Writes a line of the outline, naming the asyncio task it is from."""
+        task_name = self._thread_state.current().task_name
+        if task_name is not None:
+            line = '[%s] %s' % (task_name, line)
+        self.sink.write(line)
 
     def trace_call(self, func_name, inspector, args, kwargs):
         cft = self.frame_tracer(func_name, inspector, args, kwargs)
         self.call_stack.append(cft)
         self.report_call(inspector.qual_name, args, kwargs)
 
+    def trace_resume(self, func_name, inspector):
+        cft = self._thread_state.current().suspended.pop(id(inspector.frame), None)
+        if cft is None:
+            # Suspended before tracing started
+            if self.call_args:
+                self.trace_call(func_name, inspector, inspector.args, inspector.kwargs)
+            else:
+                self.trace_call(func_name, inspector, (), {})
+        else:
+            cft.trace_resume(func_name, inspector)
+            self.call_stack.append(cft)
+
+    def trace_suspend(self, func_name, value):
+        state = self._thread_state.current()
+        if state.call_stack:
+            cft = state.call_stack.pop()
+            inclusive_ns = cft.inclusive_ns
+            cft.trace_suspend(func_name, value)
+            if state.call_stack:
+                state.call_stack[-1].child_ns += cft.inclusive_ns - inclusive_ns
+            # A frame's id can be reused once it is gone, so move it last
+            state.suspended.pop(cft.frame_id, None)
+            state.suspended[cft.frame_id] = cft
+            if len(state.suspended) > self.max_suspended:
+                state.suspended.popitem(last=False)
+
     def trace_line(self, *args, **kwargs):
-        self.current.trace_line(*args, **kwargs)
+        call_stack = self.call_stack
+        if call_stack:
+            call_stack[-1].trace_line(*args, **kwargs)
 
     def trace_return(self, func_name, return_value):
         """Logs the return value at the appropriate level in the graph output."""
-        self.current.trace_return(func_name, return_value)
-        if self.call_stack:
-            print(' ' * (self.depth - 1), 'return ', repr(return_value), sep='', file=self.out)
-            self.call_stack.pop()
+        call_stack = self.call_stack
+        if not call_stack:
+            # Called before a reset()
+            return
+        cft = call_stack[-1]
+        inclusive_ns = cft.inclusive_ns
+        cft.trace_return(func_name, return_value)
+        self.write(' ' * (len(call_stack) - 1) + 'return ' + self.arg_repr.repr(return_value))
+        self._pop_frame(call_stack, cft, inclusive_ns)
+
+    def _pop_frame(self, call_stack, cft, inclusive_ns):
+        """Take a returned frame tracer off the stack, adding its time to
+        its caller and to the timings. ``inclusive_ns`` is its time before
+        the return.
+        """
+
+        call_stack.pop()
+        if call_stack:
+            call_stack[-1].child_ns += cft.inclusive_ns - inclusive_ns
+
+        qual_name = cft.qual_name
+        timings = self._thread_timings.timings
+        timing = timings.get(qual_name)
+        if timing is None:
+            timing = timings[qual_name] = FunctionTiming(qual_name)
+        timing.add(cft.inclusive_ns, cft.exclusive_ns)
 
     def trace_exception(self, *args, **kwargs):
-        self.current.trace_exception(*args, **kwargs)
+        call_stack = self.call_stack
+        if call_stack:
+            call_stack[-1].trace_exception(*args, **kwargs)
+
+    @property
+    def timings(self):
+        """A ``FunctionTiming`` for each function called, by qualified name."""
+
+        merged = {}
+        for timings, in list(self._all_timings):
+            for qual_name, timing in list(timings.items()):
+                if qual_name not in merged:
+                    merged[qual_name] = FunctionTiming(qual_name)
+                merged[qual_name].merge(timing)
+        return merged
+
+    def format_timings(self):
+        """The lines of a table of the ``timings``, in milliseconds, the
+        functions taking the most time first.
+        """
+
+        lines = ['%8s %12s %12s %10s %10s  %s' % (
+            'count', 'total', 'self', 'min', 'max', 'function')]
+        timings = sorted(self.timings.values(), key=lambda t: (-t.total_ns, t.qual_name))
+        for t in timings:
+            lines.append('%8d %12.3f %12.3f %10.3f %10.3f  %s' % (
+                t.count, t.total_ns / 1e6, t.self_ns / 1e6, t.min_ns / 1e6, t.max_ns / 1e6,
+                t.qual_name))
+        return lines
+
+    def write_timings(self, out=None):
+        """Write the table of ``format_timings()`` to a file."""
+
+        for line in self.format_timings():
+            print(line, file=out)
+
+    def finish(self):
+        if self.report_timings:
+            self.sink.write_lines(self.format_timings())
+            self.sink.flush()
+
+
+def _merge_counts(dicts):
+    merged = {}
+    for counts in list(dicts):
+        for key, (calls, ns) in list(counts.items()):
+            total = merged.get(key)
+            if total is None:
+                merged[key] = [calls, ns]
+            else:
+                total[0] += calls
+                total[1] += ns
+    return merged
+
+
+class CallGraphTracer(StackTracer):
+    """Aggregates the call graph rather than writing it out, so its size
+    depends on how many distinct stacks there are, not how many calls.
+
+    ``stacks`` counts the calls and their exclusive nanoseconds for each
+    stack, a tuple of code ids from the outermost frame, and ``edges`` the
+    calls and their inclusive nanoseconds from each caller to each callee.
+    ``names`` gives the qualified name, file and first line of each code id.
+    They can be written as collapsed stacks for flamegraph tools, or as a
+    callgrind file for tools like KCachegrind.
+    """
+
+    call_args = False
+
+    def __init__(self, **kwargs):
+        super(CallGraphTracer, self).__init__(NullSink(), **kwargs)
+        self.names = {}
+        self._all_graphs = []
+        self._thread_graph = _ThreadDicts(self._all_graphs, 'stacks', 'edges')
+
+    def report_call(self, func_name, args, kwargs):
+        pass
+
+    def trace_call(self, func_name, inspector, args, kwargs):
+        info = inspector.code_info
+        serial = info.serial
+        if serial not in self.names:
+            code = inspector.frame.f_code
+            self.names[serial] = (info.qual_name, code.co_filename, code.co_firstlineno)
+        call_stack = self.call_stack
+        cft = self.frame_tracer(func_name, inspector, args, kwargs)
+        if call_stack:
+            cft.stack_key = call_stack[-1].stack_key + (serial,)
+        else:
+            cft.stack_key = (serial,)
+        call_stack.append(cft)
+
+    def trace_return(self, func_name, return_value):
+        call_stack = self.call_stack
+        if not call_stack:
+            return
+        cft = call_stack[-1]
+        inclusive_ns = cft.inclusive_ns
+        cft.trace_return(func_name, return_value)
+        self._pop_frame(call_stack, cft, inclusive_ns)
+
+        graph = self._thread_graph
+        key = cft.stack_key
+        counts = graph.stacks.get(key)
+        if counts is None:
+            graph.stacks[key] = [1, cft.exclusive_ns]
+        else:
+            counts[0] += 1
+            counts[1] += cft.exclusive_ns
+        if len(key) > 1:
+            key = key[-2:]
+            counts = graph.edges.get(key)
+            if counts is None:
+                graph.edges[key] = [1, cft.inclusive_ns]
+            else:
+                counts[0] += 1
+                counts[1] += cft.inclusive_ns
+
+    @property
+    def stacks(self):
+        """``[calls, exclusive_ns]`` for each stack of code ids."""
+
+        return _merge_counts(stacks for stacks, edges in self._all_graphs)
+
+    @property
+    def edges(self):
+        """``[calls, inclusive_ns]`` for each ``(caller, callee)`` pair of
+        code ids.
+        """
+
+        return _merge_counts(edges for stacks, edges in self._all_graphs)
+
+    def write_collapsed(self, out=None, weight='calls'):
+        """Write the stacks collapsed, one ``a;b;c count`` line per stack,
+        the format read by flamegraph tools. ``weight`` is ``'calls'`` to
+        count the calls of each stack, or ``'time'`` for their exclusive
+        microseconds.
+        """
+
+        if weight not in ('calls', 'time'):
+            raise ValueError("Unknown weight %r" % (weight,))
+        lines = []
+        for key, (calls, ns) in self.stacks.items():
+            stack = ';'.join(self.names[serial][0] for serial in key)
+            lines.append('%s %d' % (stack, calls if weight == 'calls' else ns // 1000))
+        for line in sorted(lines):
+            print(line, file=out)
+
+    def write_callgrind(self, out):
+        """Write the call graph in the callgrind format, with the cost in
+        nanoseconds. ``out`` is a path or a file opened in text mode.
+        """
+
+        if isinstance(out, basestring):
+            with open(out, 'w') as f:
+                return self.write_callgrind(f)
+        self_ns = collections.defaultdict(int)
+        for key, (calls, ns) in self.stacks.items():
+            self_ns[key[-1]] += ns
+        callees = collections.defaultdict(list)
+        for (caller, callee), counts in sorted(self.edges.items()):
+            callees[caller].append((callee, counts))
+
+        # Files and functions are compressed to ids after their first use
+        file_ids = {}
+        named = set()
+        def file_name(kind, filename):
+            if filename in file_ids:
+                return '%s=(%d)' % (kind, file_ids[filename])
+            file_ids[filename] = len(file_ids) + 1
+            return '%s=(%d) %s' % (kind, file_ids[filename], filename)
+        def func_name(kind, serial):
+            if serial in named:
+                return '%s=(%d)' % (kind, serial)
+            named.add(serial)
+            return '%s=(%d) %s' % (kind, serial, self.names[serial][0])
+
+        print('# callgrind format', file=out)
+        print('version: 1', file=out)
+        print('creator: tracerlib', file=out)
+        print('positions: line', file=out)
+        print('events: Nanoseconds', file=out)
+        for serial in sorted(set(self_ns) | set(callees)):
+            qual_name, filename, lineno = self.names[serial]
+            print('', file=out)
+            print(file_name('fl', filename), file=out)
+            print(func_name('fn', serial), file=out)
+            print('%d %d' % (lineno, self_ns[serial]), file=out)
+            for callee, (calls, ns) in callees[serial]:
+                callee_file, callee_line = self.names[callee][1:]
+                print(file_name('cfl', callee_file), file=out)
+                print(func_name('cfn', callee), file=out)
+                print('calls=%d %d' % (calls, callee_line), file=out)
+                print('%d %d' % (lineno, ns), file=out)
+
+
+_BINARY_MAGIC = b'TRLB'
+# Version 2 added the suspend and resume records
+_BINARY_VERSION = 2
+_binary_header = struct.Struct('<4sHH')
+# Event type, depth, code id, thread id, timestamp in nanoseconds
+_binary_record = struct.Struct('<BxHIQQ')
+_binary_max_depth = 0xffff
+# Record types, by their number in the file. Names are written as a record
+# followed by the UTF-8 encoded name, padded to a multiple of the record size.
+# A generator or coroutine resuming or suspending is recorded as a resume or
+# suspend rather than a call or return.
+_binary_events = ['name', 'call', 'return', 'exception', 'resume', 'suspend']
+_binary_event_types = dict((e, i) for (i, e) in enumerate(_binary_events))
+# The events a BinaryTracer can be given
+_binary_tracer_events = frozenset(['call', 'return', 'exception'])
+
+BinaryRecord = collections.namedtuple('BinaryRecord',
+    ['event', 'qual_name', 'code_id', 'thread_id', 'depth', 'timestamp'])
+
+
+class BinaryTracer(Tracer):
+    """Records events as compact, fixed-size binary records, leaving all
+    formatting to ``read_binary_trace()`` and ``decode_outline()``, outside
+    of the traced process.
+
+    Each record holds the event type, an id for the code object, the thread
+    id, the depth of the call stack of the thread or asyncio task, recorded
+    as at most 65535, and a monotonic timestamp. Generators and coroutines
+    suspending and resuming get records of their own. The qualified name of
+    each code object is written once, the first time it is seen. ``out`` is
+    a path or a file opened in binary mode. Records are collected in a
+    preallocated buffer of ``buffer_records`` records before being written,
+    and are flushed when the ``TracerManager`` stops.
+    """
+
+    def __init__(self, out, events=('call', 'return'), buffer_records=4096, **kwargs):
+        for event in events:
+            if event not in _binary_tracer_events:
+                raise ValueError("BinaryTracer can't record %r events" % (event,))
+        super(BinaryTracer, self).__init__(events=events, **kwargs)
+        if isinstance(out, basestring):
+            self.out = open(out, 'wb')
+            self._owns_out = True
+        else:
+            self.out = out
+            self._owns_out = False
+        self._buffer = bytearray(_binary_record.size * buffer_records)
+        self._pos = 0
+        self._lock = threading.Lock()
+        self._names = set()
+        self.out.write(_binary_header.pack(_BINARY_MAGIC, _BINARY_VERSION, _binary_record.size))
+
+    def dispatch(self, fi, event, arg):
+        # Bypasses the trace_* methods, so no arguments are ever read
+        self.frame_insp = fi
+        if not self._check(fi, event, arg):
+            return False
+        info = fi.code_info
+        state = self._thread_state.current()
+        if event == 'call':
+            state.incall += 1
+            state.depth += 1
+            if fi.resumed:
+                event = 'resume'
+        elif event == 'return':
+            if state.incall > 0:
+                state.incall -= 1
+            if fi.suspended:
+                event = 'suspend'
+        depth = state.depth
+        if event in ('return', 'suspend') and depth > 0:
+            state.depth -= 1
+
+        with self._lock:
+            if info.serial not in self._names:
+                self._names.add(info.serial)
+                name = info.qual_name.encode('utf-8')
+                size = _binary_record.size
+                padded = name + b'\0' * (-len(name) % size)
+                self._append(_binary_record.pack(0, 0, info.serial, len(name), 0) + padded)
+            self._append(_binary_record.pack(
+                _binary_event_types[event], min(depth, _binary_max_depth), info.serial,
+                _get_ident(), _clock_ns()))
+        return True
+
+    def _append(self, data):
+        end = self._pos + len(data)
+        if end > len(self._buffer):
+            self._write_buffer()
+            end = len(data)
+            if end > len(self._buffer):
+                self.out.write(data)
+                return
+        self._buffer[self._pos:end] = data
+        self._pos = end
+
+    def _write_buffer(self):
+        self.out.write(bytes(self._buffer[:self._pos]))
+        self._pos = 0
+
+    def flush(self):
+        """Write all the buffered records to the file."""
+
+        with self._lock:
+            self._write_buffer()
+        self.out.flush()
+
+    def finish(self):
+        self.flush()
+
+    def close(self):
+        """Flush the records, closing the file if it was opened from a path."""
+
+        self.flush()
+        if self._owns_out:
+            self.out.close()
+
+
+def read_binary_trace(f):
+    """Read a file written by ``BinaryTracer``, yielding ``BinaryRecord``
+    tuples. ``f`` is a path or a file opened in binary mode.
+    """
+
+    if isinstance(f, basestring):
+        with open(f, 'rb') as fp:
+            for record in read_binary_trace(fp):
+                yield record
+        return
+    header = f.read(_binary_header.size)
+    if len(header) < _binary_header.size:
+        raise ValueError("Not a tracerlib binary trace")
+    magic, version, size = _binary_header.unpack(header)
+    if magic != _BINARY_MAGIC or not 1 <= version <= _BINARY_VERSION:
+        raise ValueError("Not a tracerlib binary trace")
+    names = {}
+    while True:
+        data = f.read(size)
+        if len(data) < size:
+            return
+        event, depth, code_id, thread_id, timestamp = _binary_record.unpack(data)
+        if event == 0:
+            # thread_id holds the length of the name
+            name = f.read(thread_id + (-thread_id % size))[:thread_id]
+            names[code_id] = name.decode('utf-8')
+        else:
+            yield BinaryRecord(_binary_events[event], names.get(code_id, '<unknown>'),
+                               code_id, thread_id, depth, timestamp)
+
+def decode_outline(f, out=None):
+    """Write the outline ``StackTracer`` would have written for a binary trace,
+    without the argument and return values, which are not recorded. Like
+    ``StackTracer``, generators and coroutines suspending and resuming are
+    left out.
+    """
+
+    for record in read_binary_trace(f):
+        if record.event == 'call':
+            print(' ' * (record.depth - 1) + record.qual_name + '()', file=out)
+        elif record.event == 'return':
+            print(' ' * (record.depth - 1) + 'return', file=out)
+
+
+class StackSampler(object):
+    """A statistical profiler, which samples the call stacks of the running
+    threads at a fixed ``interval``, in seconds, instead of tracing every
+    event. ``counts`` maps each stack sampled, a tuple of qualified names from
+    the outermost frame in, to the number of times it was seen.
+
+    With the default ``mode``, ``'thread'``, a background thread samples all
+    the other threads. With ``'signal'``, ``SIGPROF`` is used to sample the
+    main thread every ``interval`` seconds of CPU time; it must be started
+    from the main thread.
+
+    Can be used as a context manager.
+    """
+
+    def __init__(self, interval=0.005, mode='thread'):
+        if mode not in ('thread', 'signal'):
+            raise ValueError("Unknown mode %r" % (mode,))
+        self.interval = interval
+        self.mode = mode
+        self.counts = collections.defaultdict(int)
+        self.samples = 0
+        self._thread = None
+        self._stopping = threading.Event()
+        self._old_handler = None
+
+    def sample(self, frame):
+        """Record the stack leading to ``frame``."""
+
+        names = []
+        while frame is not None:
+            names.append(code_info(frame.f_code).qual_name)
+            frame = frame.f_back
+        names.reverse()
+        self.counts[tuple(names)] += 1
+        self.samples += 1
+
+    def start(self):
+        """Start sampling."""
+
+        if self.mode == 'signal':
+            self._old_handler = signal.signal(signal.SIGPROF, self._handle_signal)
+            signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+        else:
+            self._stopping.clear()
+            self._thread = _start_internal_thread(self._run, 'tracerlib-sampler')
+        return self
+    __enter__ = start
+
+    def stop(self):
+        """Stop sampling. The counts are kept."""
+
+        if self.mode == 'signal':
+            signal.setitimer(signal.ITIMER_PROF, 0, 0)
+            signal.signal(signal.SIGPROF, self._old_handler or signal.SIG_DFL)
+        elif self._thread is not None:
+            self._stopping.set()
+            self._thread.join()
+            self._thread = None
+
+    def __exit__(self, type_, value, tb):
+        self.stop()
+
+    def _handle_signal(self, signum, frame):
+        self.sample(frame)
+
+    def _run(self):
+        while not self._stopping.wait(self.interval):
+            for ident, frame in sys._current_frames().items():
+                if ident not in _internal_threads:
+                    self.sample(frame)
+
+    def write_collapsed(self, out=None):
+        """Write the counts as collapsed stacks, one ``a;b;c count`` line per
+        stack, the format read by flamegraph tools.
+        """
+
+        for stack, count in sorted(self.counts.items()):
+            print('%s %d' % (';'.join(stack), count), file=out)
 
 
 class ConfigLoader(object):
@@ -520,9 +3061,13 @@ class ConfigLoader(object):
 
     on:line
     match:mypackage.*
+    sample:100
     -  on:call
        match:otherlibrary.somefunction
        log:args
+
+    A nested block is a child tracer of the block it is in, and is only
+    given events while its parent is in a call.
     """
     
     def __init__(self, tracer=Tracer):
@@ -637,23 +3182,41 @@ class ConfigLoader(object):
         return data
 
 
-_pth = """import sys,tracerlib;tracerlib.addtracer(tracerlib.StackTracer(sys.stderr)) if not tracerlib._global_env_tracer else None;tracerlib._global_env_tracer=True"""
+_pth = """import sys,tracerlib;tracerlib.addtracer(tracerlib.StackTracer(%s)) if not tracerlib._global_env_tracer else None;tracerlib._global_env_tracer=True"""
 def main(args):
+    if len(args) > 2 and args[1] == 'decode':
+        for path in args[2:]:
+            decode_outline(path)
+        return
+    if len(args) > 2 and args[1] == 'merge':
+        if args[2] == '--summary':
+            summarize_process_traces(args[3:])
+        else:
+            merge_process_traces(args[2:])
+        return
     this_env = sys.path[-1]
     if os.path.split(this_env)[-1] == 'site-packages':
         pth_path = os.path.join(this_env, 'tracerlib.pth')
         if args:
-            cmd = args[-1]
+            cmd = args[1] if len(args) > 1 else None
             if cmd == 'off':
                 os.unlink(pth_path)
             elif cmd == 'on':
+                if len(args) > 2:
+                    out = 'tracerlib.ProcessFileSink(%r)' % (os.path.abspath(args[2]),)
+                else:
+                    out = 'sys.stderr'
                 with open(pth_path, 'w') as f:
-                    f.write(_pth)
+                    f.write(_pth % (out,))
             else:
                 print("Tracerlib commands:")
                 print()
-                print("on: Enable tracing of this virtual environment")
+                print("on [DIR]: Enable tracing of this virtual environment, to a file")
+                print("          for each process in DIR if given, or else to stderr")
                 print("off: Disable tracing of this virtual environment")
+                print("decode FILE...: Print the outline of binary trace files")
+                print("merge [--summary] FILE...: Print the lines of process trace")
+                print("          files in time order, or a summary of each process")
 
 
 if __name__ == '__main__':